@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import concurrent.futures
+from functools import partial
+from tqdm import tqdm
+from score_to_tokens import MusicXML_to_tokens
+from token_cache import DEFAULT_MAX_BYTES, open_cache, cached_tokenize
+import instrumentation
+
+"""
+Batch tokenization of MusicXML files across a process pool
+
+Results keep the order of the input paths, files that fail to tokenize
+are recorded in a failure manifest (path, exception type, message, time).
+"""
+
+# one token cache connection per process
+cache_connections = {}
+
+
+def tokenize_file(path, note_name=True, cache_path=None, cache_size=DEFAULT_MAX_BYTES,
+                  tokenizer=MusicXML_to_tokens):
+    '''
+    Tokenize a single file, returns (path, tokens, failure)
+    '''
+    start = time.perf_counter()
+    try:
+        if cache_path is not None:
+            if cache_path not in cache_connections:
+                cache_connections[cache_path] = open_cache(cache_path)
+            tokens = cached_tokenize(cache_connections[cache_path], path,
+                                     tokenizer, note_name, cache_size)
+        else:
+            tokens = tokenizer(path, note_name=note_name)
+    except Exception as e:
+        failure = {
+            'path': path,
+            'error': type(e).__name__,
+            'message': str(e),
+            'time': time.perf_counter() - start,
+        }
+        return path, None, failure
+    return path, tokens, None
+
+
+def has_failure(result):
+    return result[2] is not None
+
+
+def tokenize_batch(paths, num_workers=os.cpu_count(), chunksize=16, note_name=True,
+                   cache_path=None, cache_size=DEFAULT_MAX_BYTES, tokenizer=MusicXML_to_tokens):
+    '''
+    Tokenize paths in chunks across num_workers processes.
+    Returns the list of (path, tokens) in input order and the list of failures.
+    When cache_path is given, tokens are read from / stored in the token cache.
+    tokenizer is a module-level function (path, note_name=...), e.g. MusicXML_to_tokens_stream.
+    '''
+    results, failures = [], []
+    worker = instrumentation.traced('tokenize', partial(tokenize_file, note_name=note_name,
+                                                        cache_path=cache_path, cache_size=cache_size,
+                                                        tokenizer=tokenizer),
+                                    has_failure)
+
+    with instrumentation.stage('tokenize', len(paths)):
+        if num_workers is None or num_workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+            outputs = executor.map(worker, paths, chunksize=chunksize)
+        else:  # run in the main process
+            executor = None
+            outputs = map(worker, paths)
+
+        try:
+            for path, tokens, failure in tqdm(outputs, 'Tokenizing', total=len(paths)):
+                if failure is not None:
+                    failures.append(failure)
+                else:
+                    results.append((path, tokens))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    return results, failures
+
+
+def write_failure_manifest(failures, filename):
+    '''
+    Write one JSON object per failed file
+    '''
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        for failure in failures:
+            f.write(json.dumps(failure) + '\n')
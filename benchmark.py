@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import time
+import random
+import cProfile
+import pstats
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from score_to_tokens import MusicXML_to_tokens
+from score_to_tokens_stream import MusicXML_to_tokens_stream
+from tokens_to_score import tokens_to_score
+from tokens_to_musicxml import tokens_to_musicxml
+from tokens_to_midi import tokens_to_midi
+
+"""
+Benchmark the tokenizer and detokenizer engines
+
+Scores are generated with a deterministic synthetic piano MusicXML generator
+(single part, two staves) staying within what MusicXML_to_tokens handles.
+For each engine the suite reports files/s, tokens/s, peak Python memory and
+the time spent in each function of the repository, and saves the results as
+JSON so that runs can be compared (--compare).
+"""
+
+step_names = ['C', 'C', 'D', 'D', 'E', 'F', 'F', 'G', 'G', 'A', 'A', 'B']
+step_alters = [0, 1, 0, 1, 0, 0, 1, 0, 1, 0, 1, 0]
+
+# measure length in divisions (4 per quarter) for each time signature
+time_signatures = {(4, 4): 16, (3, 4): 12, (2, 4): 8, (6, 8): 12}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark tokenization and detokenization')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Number of synthetic scores')
+    parser.add_argument('--measures', type=int, default=32,
+                        help='Measures per score')
+    parser.add_argument('--voices', type=int, default=2,
+                        help='Voices per staff')
+    parser.add_argument('--chord_density', type=float, default=0.3,
+                        help='Probability for a note to be a chord')
+    parser.add_argument('--tie_prob', type=float, default=0.1,
+                        help='Probability for a note to be tied to the previous one')
+    parser.add_argument('--no_beams', action='store_true',
+                        help='Do not beam eighth notes')
+    parser.add_argument('--attribute_every', type=int, default=8,
+                        help='Change key, time signature and bass clef every n measures (0: never)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Benchmark the MusicXML files of this directory instead of synthetic ones')
+    parser.add_argument('--tokenizers', type=str, nargs='*', default=None,
+                        help='Tokenizer engines to run (default: all)')
+    parser.add_argument('--detokenizers', type=str, nargs='*', default=None,
+                        help='Detokenizer engines to run (default: all)')
+    parser.add_argument('--no_profile', action='store_true',
+                        help='Skip the per-function profile')
+    parser.add_argument('--output', type=str, default='bench_results.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='JSON results of a previous run to compare with')
+    return parser.parse_args()
+
+
+def midi_to_pitch(midi):
+    step = step_names[midi % 12]
+    alter = step_alters[midi % 12]
+    octave = midi // 12 - 1
+    return step, alter, octave
+
+
+def generate_voice(rng, measure_len, staff, voice, chord_density, tie_prob, beams):
+    '''
+    Generate the notes of one voice filling a measure
+    '''
+    low, high = (60, 84) if staff == 1 else (36, 60)
+    stem = 'up' if voice % 4 == 1 else 'down'
+    notes = []
+    position = 0
+    while position < measure_len:
+        remaining = measure_len - position
+        duration = rng.choice([d for d in (16, 8, 4, 2) if d <= remaining])
+
+        if duration == 2 and remaining >= 4:  # beamed pair of eighths
+            durations = [2, 2]
+        else:
+            durations = [duration]
+
+        for i, d in enumerate(durations):
+            previous = notes[-1] if notes else None
+            if rng.random() < 0.1:
+                notes.append({'rest': True, 'duration': d})
+            else:
+                if previous is not None and not previous['rest'] and rng.random() < tie_prob:
+                    pitches = list(previous['pitches'])
+                    previous['tie'] = 'stop' if previous.get('tie') == 'stop' else 'start'
+                    tie = 'stop'
+                else:
+                    pitches = [rng.randint(low, high)]
+                    if rng.random() < chord_density:
+                        pitches += sorted(rng.sample(range(pitches[0] + 1, pitches[0] + 13),
+                                                     rng.randint(1, 3)))
+                    tie = None
+                beam = None
+                if beams and len(durations) == 2:
+                    beam = 'begin' if i == 0 else 'end'
+                notes.append({'rest': False, 'duration': d, 'pitches': pitches,
+                              'stem': stem, 'beam': beam, 'tie': tie})
+            position += d
+    return notes
+
+
+def note_to_xml(note, voice, staff, chord=False, pitch=None):
+    lines = ['<note>']
+    if chord:
+        lines.append('<chord/>')
+    if note['rest']:
+        lines.append('<rest/>')
+    else:
+        step, alter, octave = midi_to_pitch(pitch)
+        lines.append('<pitch>')
+        lines.append(f'<step>{step}</step>')
+        if alter:
+            lines.append(f'<alter>{alter}</alter>')
+        lines.append(f'<octave>{octave}</octave>')
+        lines.append('</pitch>')
+    lines.append(f"<duration>{note['duration']}</duration>")
+    if not note['rest'] and note['tie'] is not None:
+        lines.append(f"<tie type=\"{note['tie']}\"/>")
+    lines.append(f'<voice>{voice}</voice>')
+    if not note['rest']:
+        lines.append(f"<stem>{note['stem']}</stem>")
+    lines.append(f'<staff>{staff}</staff>')
+    if not note['rest'] and note['beam'] is not None and not chord:
+        lines.append(f"<beam number=\"1\">{note['beam']}</beam>")
+    if not note['rest'] and note['tie'] is not None:
+        lines.append(f"<notations><tied type=\"{note['tie']}\"/></notations>")
+    lines.append('</note>')
+    return lines
+
+
+def generate_musicxml(seed=0, measures=32, voices=2, chord_density=0.3, tie_prob=0.1,
+                      beams=True, attribute_every=8):
+    '''
+    Deterministic synthetic piano score (one part, two staves) as a MusicXML string
+    '''
+    rng = random.Random(seed)
+    fifths = 0
+    time_signature = (4, 4)
+    bass_clef = True
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<score-partwise version="3.1">',
+             '<part-list><score-part id="P1"><part-name>Piano</part-name></score-part></part-list>',
+             '<part id="P1">']
+    for m in range(measures):
+        lines.append(f'<measure number="{m + 1}">')
+
+        if m == 0 or (attribute_every and m % attribute_every == 0):
+            if m > 0:
+                fifths = rng.randint(-6, 6)
+                time_signature = rng.choice(list(time_signatures))
+                bass_clef = not bass_clef
+            lines.append('<attributes>')
+            if m == 0:
+                lines.append('<divisions>4</divisions>')
+            lines.append(f'<key><fifths>{fifths}</fifths></key>')
+            lines.append(f'<time><beats>{time_signature[0]}</beats>'
+                         f'<beat-type>{time_signature[1]}</beat-type></time>')
+            if m == 0:
+                lines.append('<staves>2</staves>')
+                lines.append('<clef number="1"><sign>G</sign><line>2</line></clef>')
+            if bass_clef:
+                lines.append('<clef number="2"><sign>F</sign><line>4</line></clef>')
+            else:
+                lines.append('<clef number="2"><sign>G</sign><line>2</line></clef>')
+            lines.append('</attributes>')
+
+        measure_len = time_signatures[time_signature]
+        for staff in (1, 2):
+            for v in range(voices):
+                voice = (staff - 1) * 4 + v + 1
+                notes = generate_voice(rng, measure_len, staff, voice,
+                                       chord_density, tie_prob, beams)
+                for note in notes:
+                    if note['rest']:
+                        lines += note_to_xml(note, voice, staff)
+                    else:
+                        for i, pitch in enumerate(note['pitches']):
+                            lines += note_to_xml(note, voice, staff, chord=i > 0, pitch=pitch)
+                if not (staff == 2 and v == voices - 1):
+                    lines.append(f'<backup><duration>{measure_len}</duration></backup>')
+
+        lines.append('</measure>')
+    lines += ['</part>', '</score-partwise>']
+    return '\n'.join(lines)
+
+
+def generate_corpus(output_dir, n_files, seed=0, **kwargs):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(n_files):
+        path = os.path.join(output_dir, f'synthetic_{i:05d}.musicxml')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(generate_musicxml(seed=seed + i, **kwargs))
+        paths.append(path)
+    return paths
+
+
+def tokens_to_musicxml_music21(tokens):
+    return tokens_to_score(' '.join(tokens))
+
+
+def tokens_to_musicxml_music21_export(tokens):
+    from music21.musicxml.m21ToXml import GeneralObjectExporter
+    return GeneralObjectExporter(tokens_to_score(' '.join(tokens))).parse()
+
+
+tokenizers = {
+    'bs4': MusicXML_to_tokens,
+    'bs4_single_pass': lambda path: MusicXML_to_tokens(path, single_pass=True),
+    'stream': MusicXML_to_tokens_stream,
+}
+
+detokenizers = {
+    'music21': tokens_to_musicxml_music21,
+    'music21_export': tokens_to_musicxml_music21_export,
+    'direct': lambda tokens: tokens_to_musicxml(' '.join(tokens)),
+    'midi': lambda tokens: tokens_to_midi(' '.join(tokens)),
+}
+
+
+def run_engine(func, inputs, count_tokens):
+    '''
+    Timing pass (no tracing), returns the outputs, elapsed time and failures
+    '''
+    outputs, failures = [], 0
+    start = time.perf_counter()
+    for x in inputs:
+        try:
+            outputs.append(func(x))
+        except Exception:
+            outputs.append(None)
+            failures += 1
+    elapsed = time.perf_counter() - start
+
+    n_tokens = sum(count_tokens(x, y) for x, y in zip(inputs, outputs) if y is not None)
+    return outputs, elapsed, failures, n_tokens
+
+
+def peak_memory(func, inputs):
+    tracemalloc.start()
+    for x in inputs:
+        try:
+            func(x)
+        except Exception:
+            pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def profile_functions(func, inputs, top=15):
+    '''
+    Cumulative time of the repository functions called by func
+    '''
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for x in inputs:
+        try:
+            func(x)
+        except Exception:
+            pass
+    profiler.disable()
+
+    stats = pstats.Stats(profiler).stats
+    functions = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.items():
+        if os.path.dirname(os.path.abspath(filename)) != repo_dir or filename.endswith('benchmark.py'):
+            continue
+        functions.append({'function': f'{os.path.basename(filename)}:{name}',
+                          'calls': ncalls, 'tottime': tottime, 'cumtime': cumtime})
+    return sorted(functions, key=lambda f: f['cumtime'], reverse=True)[:top]
+
+
+def benchmark_engine(func, inputs, count_tokens, profile=True):
+    outputs, elapsed, failures, n_tokens = run_engine(func, inputs, count_tokens)
+    result = {
+        'files': len(inputs),
+        'failures': failures,
+        'seconds': elapsed,
+        'files_per_s': len(inputs) / elapsed if elapsed else None,
+        'tokens_per_s': n_tokens / elapsed if elapsed else None,
+        'peak_memory_bytes': peak_memory(func, inputs),
+    }
+    if profile:
+        result['functions'] = profile_functions(func, inputs)
+    return outputs, result
+
+
+def compare_results(current, previous):
+    for section in ('tokenize', 'detokenize'):
+        for engine, result in current[section].items():
+            old = previous.get(section, {}).get(engine)
+            if old is None or not old.get('files_per_s') or not result.get('files_per_s'):
+                continue
+            ratio = result['files_per_s'] / old['files_per_s']
+            memory = result['peak_memory_bytes'] / max(old['peak_memory_bytes'], 1)
+            print(f'{section:10s} {engine:20s} speed x{ratio:.2f}  peak memory x{memory:.2f}')
+
+
+def main():
+    args = parse_args()
+
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.data_dir is not None:
+            paths = sorted(os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir)
+                           if f.endswith('.musicxml') or f.endswith('.xml'))
+        else:
+            paths = generate_corpus(tmp_dir, args.files, seed=args.seed, measures=args.measures,
+                                    voices=args.voices, chord_density=args.chord_density,
+                                    tie_prob=args.tie_prob, beams=not args.no_beams,
+                                    attribute_every=args.attribute_every)
+
+        results = {
+            'config': config,
+            'environment': {'python': sys.version.split()[0], 'platform': platform.platform()},
+            'tokenize': {},
+            'detokenize': {},
+        }
+
+        tokens_list = None
+        for name in args.tokenizers or tokenizers:
+            outputs, result = benchmark_engine(tokenizers[name], paths,
+                                               lambda x, y: len(y), not args.no_profile)
+            results['tokenize'][name] = result
+            if tokens_list is None:
+                tokens_list = [t for t in outputs if t is not None]
+            print(f"tokenize   {name:20s} {result['files_per_s']:8.2f} files/s "
+                  f"{result['tokens_per_s']:10.0f} tokens/s  peak {result['peak_memory_bytes'] / 1024 ** 2:.1f} MB")
+
+    for name in args.detokenizers or detokenizers:
+        _, result = benchmark_engine(detokenizers[name], tokens_list or [],
+                                     lambda x, y: len(x), not args.no_profile)
+        results['detokenize'][name] = result
+        print(f"detokenize {name:20s} {result['files_per_s']:8.2f} files/s "
+              f"{result['tokens_per_s']:10.0f} tokens/s  peak {result['peak_memory_bytes'] / 1024 ** 2:.1f} MB"
+              f"  ({result['failures']} failures)")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
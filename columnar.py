@@ -0,0 +1,337 @@
+import os
+import sys
+import json
+import pickle
+import argparse
+import itertools
+import numpy as np
+
+"""
+Columnar storage for the intermediate files of the pipeline
+
+A table is a directory (COLUMNAR_SUFFIX) holding:
+- table.json: the columns (kind and dtype) and the list of chunks
+- chunk_XXXXX.<column>.npy: a fixed-size column of the chunk
+- chunk_XXXXX.<column>.values.npy / .offsets.npy: a ragged column (strings
+  as UTF-8 bytes, or numeric sequences), values of row i are
+  values[offsets[i]:offsets[i + 1]]
+
+Every append writes a new chunk and then replaces table.json, so readers
+never see a partial chunk. The .npy files are memory-mapped: opening a
+table reads table.json only, rows are decoded when accessed.
+
+The intermediates (piano.pkl, piano_musicxml.pkl, pitches.pkl and the
+difficulty files) are saved and loaded with the functions at the end of
+this file, as pickles or as tables depending on the path suffix:
+- paths: one 'path' string column
+- pitches: 'path' and ragged uint8 'pitches' (MIDI numbers)
+- difficulties: 'path' and one typed column per value (int32 or float64)
+
+Conversion of an existing pickle: python columnar.py data/pitches.pkl data/pitches.cols
+"""
+
+COLUMNAR_SUFFIX = '.cols'
+PATH_SPEC = ('str', 'uint8')
+TABLE_FILE = 'table.json'
+DIFFICULTY_COLUMNS = {2: ('path', 'difficulty'),
+                      5: ('path', 'ensemble', 'p', 'argnn', 'virtuoso')}
+
+
+def is_columnar(path):
+    return path.endswith(COLUMNAR_SUFFIX)
+
+
+def columnar_path(path):
+    '''
+    Table path for a pickle path (data/pitches.pkl -> data/pitches.cols)
+    '''
+    return path if is_columnar(path) else os.path.splitext(path)[0] + COLUMNAR_SUFFIX
+
+
+def load_array(path):
+    try:
+        # plain ndarray view on the memory map, slicing a np.memmap is much slower
+        return np.load(path, mmap_mode='r').view(np.ndarray)
+    except ValueError:  # empty arrays cannot be memory-mapped
+        return np.load(path)
+
+
+def column_spec(values):
+    '''
+    (kind, dtype) of a column from its values: str, ragged (sequences) or fixed
+    '''
+    first = next((v for v in values if v is not None), None)
+    if isinstance(first, str):
+        return 'str', 'uint8'
+    if isinstance(first, (list, tuple, np.ndarray)):
+        return 'ragged', None
+    if isinstance(first, (bool, np.bool_)):
+        return 'fixed', 'bool'
+    if isinstance(first, (int, np.integer)):
+        return 'fixed', 'int32' if all(-2 ** 31 <= v < 2 ** 31 for v in values) else 'int64'
+    return 'fixed', 'float64'
+
+
+def ragged_arrays(values, kind, dtype):
+    if kind == 'str':
+        values = [v.encode('utf-8') for v in values]
+        flat = np.frombuffer(b''.join(values), dtype=np.uint8)
+    else:
+        total = sum(len(v) for v in values)
+        flat = np.fromiter(itertools.chain.from_iterable(values), dtype=np.int64, count=total)
+        if total and (flat.min() < np.iinfo(dtype).min or flat.max() > np.iinfo(dtype).max):
+            raise ValueError(f'Values out of the {dtype} range')
+        flat = flat.astype(dtype)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in values], out=offsets[1:])
+    return flat, offsets
+
+
+def write_table(path, columns, specs=None, append=False):
+    '''
+    Write (or append) the columns {name: list of values} as a new chunk.
+    specs gives the (kind, dtype) of some columns (e.g. {'pitches': ('ragged', 'uint8')}),
+    the others are typed from their values.
+    '''
+    specs = specs or {}
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) != 1:
+        raise ValueError('Columns of different lengths')
+    rows = lengths.pop()
+
+    table_file = os.path.join(path, TABLE_FILE)
+    if append and os.path.exists(table_file):
+        with open(table_file) as f:
+            table = json.load(f)
+        if set(table['columns']) != set(columns):
+            raise ValueError(f"Cannot append columns {sorted(columns)} to {sorted(table['columns'])}")
+    else:
+        table = {'columns': {}, 'chunks': []}
+        for name, values in columns.items():
+            kind, dtype = specs[name] if name in specs else column_spec(values)
+            table['columns'][name] = {'kind': kind, 'dtype': dtype or 'int64'}
+    os.makedirs(path, exist_ok=True)
+    if not append:
+        for name in os.listdir(path):
+            if name.startswith('chunk_'):
+                os.remove(os.path.join(path, name))
+
+    chunk = f"chunk_{len(table['chunks']):05d}"
+    if rows:
+        for name, values in columns.items():
+            spec = table['columns'][name]
+            prefix = os.path.join(path, f'{chunk}.{name}')
+            if spec['kind'] == 'fixed':
+                np.save(prefix + '.npy', np.asarray(values, dtype=spec['dtype']))
+            else:
+                flat, offsets = ragged_arrays(values, spec['kind'], spec['dtype'])
+                np.save(prefix + '.values.npy', flat)
+                np.save(prefix + '.offsets.npy', offsets)
+        table['chunks'].append({'name': chunk, 'rows': rows})
+
+    tmp_file = table_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(table, f, indent=2)
+    os.replace(tmp_file, table_file)
+    return table
+
+
+class Column:
+    '''
+    Read-only column of a table, chunks are memory-mapped on first access.
+    Fixed columns give numpy scalars, ragged ones array views and strings.
+    '''
+
+    def __init__(self, path, name, spec, chunks):
+        self.path = path
+        self.name = name
+        self.kind = spec['kind']
+        self.chunk_names = [c['name'] for c in chunks]
+        self.cumulative = np.cumsum([0] + [c['rows'] for c in chunks])
+        self.arrays = {}
+
+    def __len__(self):
+        return int(self.cumulative[-1])
+
+    def get_chunk(self, chunk_id):
+        if chunk_id not in self.arrays:
+            prefix = os.path.join(self.path, f'{self.chunk_names[chunk_id]}.{self.name}')
+            if self.kind == 'fixed':
+                self.arrays[chunk_id] = (load_array(prefix + '.npy'), None)
+            else:
+                self.arrays[chunk_id] = (load_array(prefix + '.values.npy'), load_array(prefix + '.offsets.npy'))
+        return self.arrays[chunk_id]
+
+    def decode(self, values, offsets, i):
+        if offsets is None:
+            return values[i]
+        item = values[offsets[i]:offsets[i + 1]]
+        return item.tobytes().decode('utf-8') if self.kind == 'str' else item
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        chunk_id = int(np.searchsorted(self.cumulative, idx, side='right')) - 1
+        values, offsets = self.get_chunk(chunk_id)
+        return self.decode(values, offsets, idx - int(self.cumulative[chunk_id]))
+
+    def __iter__(self):
+        for chunk_id in range(len(self.chunk_names)):
+            values, offsets = self.get_chunk(chunk_id)
+            if offsets is None:
+                yield from values.tolist()
+            elif self.kind == 'str':
+                data, bounds = values.tobytes(), offsets.tolist()
+                for start, end in zip(bounds, bounds[1:]):
+                    yield data[start:end].decode('utf-8')
+            else:
+                bounds = offsets.tolist()
+                for start, end in zip(bounds, bounds[1:]):
+                    yield values[start:end]
+
+    def array(self):
+        '''
+        Whole fixed column (the memory map itself for a single chunk)
+        '''
+        if self.kind != 'fixed':
+            raise ValueError(f'{self.name} is a {self.kind} column')
+        arrays = [self.get_chunk(i)[0] for i in range(len(self.chunk_names))]
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+
+class Rows:
+    '''
+    Lazy sequence of row tuples over some columns of a table
+    '''
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, idx):
+        return tuple(column[idx] for column in self.columns)
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+
+class Table:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, TABLE_FILE)) as f:
+            self.meta = json.load(f)
+        self.columns = {name: Column(path, name, spec, self.meta['chunks'])
+                        for name, spec in self.meta['columns'].items()}
+
+    def __len__(self):
+        return sum(c['rows'] for c in self.meta['chunks'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def rows(self, names=None):
+        return Rows([self.columns[name] for name in (names or list(self.columns))])
+
+
+def save_pickle(obj, filename):
+    with open(filename, 'wb') as f:
+        pickle.dump(obj, f)
+
+
+def load_pickle(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_paths(filename, paths, append=False):
+    '''
+    List of paths
+    '''
+    if not is_columnar(filename):
+        return save_pickle(paths, filename)
+    write_table(filename, {'path': list(paths)}, {'path': PATH_SPEC}, append)
+
+
+def load_paths(filename):
+    if not is_columnar(filename):
+        return load_pickle(filename)
+    return list(Table(filename)['path'])
+
+
+def save_pitches(filename, pitches, append=False):
+    '''
+    List of (path, MIDI pitches)
+    '''
+    if not is_columnar(filename):
+        return save_pickle(pitches, filename)
+    write_table(filename, {'path': [path for path, _ in pitches], 'pitches': [p for _, p in pitches]},
+                {'path': PATH_SPEC, 'pitches': ('ragged', 'uint8')}, append)
+
+
+def load_pitches(filename):
+    '''
+    Sequence of (path, pitches), the pitches of a table are uint8 arrays
+    on the memory-mapped file, only decoded when accessed
+    '''
+    if not is_columnar(filename):
+        return load_pickle(filename)
+    return Table(filename).rows(['path', 'pitches'])
+
+
+def save_rows(filename, rows, names=None, append=False):
+    '''
+    List of (path, value...) tuples, e.g. the difficulty files
+    '''
+    if not is_columnar(filename):
+        return save_pickle(rows, filename)
+    rows = list(rows)
+    width = len(rows[0]) if rows else len(names or DIFFICULTY_COLUMNS[2])
+    names = names or DIFFICULTY_COLUMNS.get(width) or ['path'] + [f'value_{i}' for i in range(1, width)]
+    write_table(filename, {name: [row[i] for row in rows] for i, name in enumerate(names)},
+                {names[0]: PATH_SPEC}, append)
+
+
+def load_rows(filename):
+    if not is_columnar(filename):
+        return load_pickle(filename)
+    return list(Table(filename).rows())
+
+
+def convert(source, destination):
+    '''
+    Convert an intermediate pickle into a table, the kind is read from the content
+    '''
+    obj = load_pickle(source)
+    first = next((item for item in obj if item is not None), None)
+    if first is None or isinstance(first, str):
+        # older filtered lists hold None for the files rejected by filter_empty
+        save_paths(destination, [path for path in obj if path is not None])
+        return 'paths'
+    if len(first) == 2 and isinstance(first[1], (list, tuple)):
+        save_pitches(destination, obj)
+        return 'pitches'
+    save_rows(destination, obj)
+    return 'rows'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert an intermediate pickle into a columnar table')
+    parser.add_argument('source', help='Pickle file')
+    parser.add_argument('destination', nargs='?', default=None,
+                        help=f'Table directory (default: source with the {COLUMNAR_SUFFIX} suffix)')
+    args = parser.parse_args()
+
+    destination = args.destination or columnar_path(args.source)
+    if not is_columnar(destination):
+        print(f'The table path must end with {COLUMNAR_SUFFIX}')
+        sys.exit(1)
+    kind = convert(args.source, destination)
+    print(f'Wrote {len(Table(destination))} row(s) ({kind}) to {destination}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import shlex
+import signal
+import tempfile
+import subprocess
+import concurrent.futures
+from tqdm import tqdm
+import instrumentation
+
+"""
+Parallel conversion pool for MuseScore batch jobs
+
+The conversion list ({'in': ..., 'out': ...} items, as written for
+`mscore -j`) is split into small sub-batches. N converter processes run at
+the same time, each on its own JSON sub-batch and with a wall-clock timeout
+of one timeout per file, capped at MAX_TIMEOUT_FILES timeouts. When a
+sub-batch crashes, the items without output are split in two and retried,
+until the bad file is alone in its sub-batch and recorded as a failure.
+When it times out, the items without output are retried one by one with
+the per-file timeout, so a hung file costs one capped batch run and one
+file timeout.
+
+The converter is any command that takes the JSON batch file as last
+argument, so a local script can replace MuseScore.
+"""
+
+DEFAULT_COMMAND = 'musescore.mscore -j'
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_TIMEOUT = 60  # seconds per file of a sub-batch
+MAX_TIMEOUT_FILES = 4  # a run on several files gets at most this many per-file timeouts
+
+
+def run_converter(command, batch, job_dir, timeout):
+    '''
+    Run the converter on one JSON sub-batch, returns (status, output)
+    where status is 'ok', 'timeout' or 'exit code N'
+    '''
+    fd, json_path = tempfile.mkstemp(suffix='.json', dir=job_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(batch, f)
+
+    # own process group, so that the converter and its children can be killed on timeout
+    process = subprocess.Popen(command + [json_path], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        output, _ = process.communicate(timeout=timeout)
+        status = 'ok' if process.returncode == 0 else f'exit code {process.returncode}'
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = process.communicate()
+        status = 'timeout'
+    finally:
+        os.remove(json_path)
+    return status, output.decode('utf-8', errors='replace')
+
+
+def convert_with_bisection(command, batch, job_dir, timeout=DEFAULT_TIMEOUT):
+    '''
+    Convert a sub-batch, bisecting the items left without output when the
+    converter crashes and retrying them one by one when it hangs.
+    Returns the converted items and the failures.
+    '''
+    converted, failures = [], []
+    pending = [batch]
+    while pending:
+        items = pending.pop()
+        start = time.perf_counter()
+        status, output = run_converter(command, items, job_dir, timeout * min(len(items), MAX_TIMEOUT_FILES))
+        # one trace event per converter run, bisected runs time the files alone
+        instrumentation.write_event({
+            'type': 'file', 'stage': 'mscz2musicxml', 'ok': status == 'ok',
+            'path': items[0]['in'] + (f' (+{len(items) - 1} files)' if len(items) > 1 else ''),
+            'seconds': time.perf_counter() - start})
+        remaining = []
+        for item in items:
+            (converted if os.path.exists(item['out']) else remaining).append(item)
+
+        if not remaining:
+            continue
+        if status == 'ok' or len(remaining) == 1:
+            # the converter finished but skipped these files, or the bad file is isolated
+            for item in remaining:
+                failures.append({
+                    'path': item['in'],
+                    'reason': 'no output' if status == 'ok' else status,
+                    'output': output[-1000:],
+                })
+        elif status == 'timeout':
+            pending += [[item] for item in reversed(remaining)]
+        else:
+            half = len(remaining) // 2
+            pending += [remaining[half:], remaining[:half]]
+    return converted, failures
+
+
+def convert_all(batch, command=DEFAULT_COMMAND, num_workers=os.cpu_count(),
+                batch_size=DEFAULT_BATCH_SIZE, timeout=DEFAULT_TIMEOUT, callback=None):
+    '''
+    Convert all the items of batch with num_workers converter processes.
+    Returns the converted items and the failures (path, reason, end of the converter output).
+    callback(converted, failures) is called in the calling thread after each sub-batch.
+    '''
+    if isinstance(command, str):
+        command = shlex.split(command)
+    sub_batches = [batch[i:i + batch_size] for i in range(0, len(batch), batch_size)]
+
+    converted, failures = [], []
+    with tempfile.TemporaryDirectory() as job_dir, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(convert_with_bisection, command, sub_batch, job_dir, timeout)
+                   for sub_batch in sub_batches]
+        with tqdm(total=len(batch), desc='Converting') as progress:
+            for future in concurrent.futures.as_completed(futures):
+                done, failed = future.result()
+                if callback is not None:
+                    callback(done, failed)
+                converted += done
+                failures += failed
+                progress.update(len(done) + len(failed))
+    return converted, failures
@@ -1,8 +1,52 @@
 import os
 import glob
 import argparse
+import numpy as np
 from tqdm import tqdm
 
+
+class Vocabulary:
+    '''
+    Token <-> ID mapping: a dict for token -> ID and a list for ID -> token
+    '''
+
+    def __init__(self, tokens):
+        self.id_to_token = list(tokens)
+        self.token_to_id = {t: i for i, t in enumerate(self.id_to_token)}
+        self.dtype = np.uint16 if len(self.id_to_token) <= np.iinfo(
+            np.uint16).max + 1 else np.int32
+
+    def __len__(self):
+        return len(self.id_to_token)
+
+    def __contains__(self, token):
+        return token in self.token_to_id
+
+    @classmethod
+    def from_file(cls, filename):
+        tokens = []
+        with open(filename, "r") as file:
+            for line in file:
+                tokens += line.rstrip().split()
+        return cls(tokens)
+
+    def save(self, filename):
+        write_to_file(self.id_to_token, filename)
+
+    def encode(self, tokens):
+        '''
+        Token sequence to an array of IDs, tokens missing from the vocabulary are skipped
+        '''
+        lookup = self.token_to_id
+        return np.array([lookup[t] for t in tokens if t in lookup], dtype=self.dtype)
+
+    def encode_batch(self, sequences):
+        return [self.encode(tokens) for tokens in sequences]
+
+    def decode(self, ids):
+        return [self.id_to_token[int(i)] for i in ids]
+
+
 def get_unique_strings(lists_of_strings):
     if lists_of_strings is None:
         return []
@@ -21,13 +65,21 @@ def write_to_file(strings, filename):
             file.write(string + "\n")
 
 
-def create_mappings(output_folder, tokens_list, unique_tokens):
-    for i, obj in enumerate(tqdm(tokens_list, 'Create mapping files')):
+def create_mappings(output_folder, tokens_list, unique_tokens, binary=False):
+    '''
+    Write one mapping file per fragment.
+    Text files hold the difficulty token followed by the IDs of the other tokens,
+    binary files (.npy) hold the IDs of the whole sequence.
+    '''
+    vocab = unique_tokens if isinstance(
+        unique_tokens, Vocabulary) else Vocabulary(unique_tokens)
+
+    for obj in tqdm(tokens_list, 'Create mapping files'):
         path, tokens = obj
-        with open(os.path.join(output_folder, os.path.splitext(os.path.basename(path))[0] + '.txt'), 'w') as f:
-            f.write(str(tokens[0]) + ' ')
-            for i in range(1, len(tokens)):
-                try:
-                    f.write(str(unique_tokens.index(tokens[i])) + ' ')
-                except ValueError as v:
-                    continue
\ No newline at end of file
+        name = os.path.join(output_folder, os.path.splitext(os.path.basename(path))[0])
+        if binary:
+            np.save(name + '.npy', vocab.encode(tokens))
+        else:
+            ids = vocab.encode(tokens[1:])
+            with open(name + '.txt', 'w') as f:
+                f.write(str(tokens[0]) + ' ' + ''.join([f'{i} ' for i in ids.tolist()]))
@@ -0,0 +1,190 @@
+import os
+import time
+import hashlib
+import sqlite3
+import itertools
+import concurrent.futures
+
+"""
+Persistent catalog of the files of the pipeline directories
+
+Every file under a scanned root is stored with its size, mtime and
+(optionally) content hash, and tagged with a stage name ('scores',
+'fragments', ...) so that the pipeline queries the files by stage and
+extension instead of walking the directories again.
+
+A refresh only lists the directories whose mtime changed since the last
+scan (a file was added, removed or renamed in it): the other directories
+cost one stat each and keep their catalog rows. Directories are scanned
+with os.scandir by a pool of threads, one directory per task, which hides
+the latency of network filesystems. The results are written in short
+transactions (WRITE_BATCH directories, each with its files), so several
+refreshes can run at the same time on one catalog. A file rewritten in
+place does not change its directory mtime, refresh(full=True) stats every
+file again.
+"""
+
+DEFAULT_WORKERS = 16
+RACY_SECONDS = 2  # directories modified this recently are scanned again on the next refresh
+HASH_BLOCK_SIZE = 1 << 20
+WRITE_BATCH = 256  # directories written per transaction
+
+
+def open_catalog(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('''CREATE TABLE IF NOT EXISTS dirs (
+                        path TEXT PRIMARY KEY,
+                        parent TEXT,
+                        stage TEXT NOT NULL,
+                        mtime_ns INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        dir TEXT NOT NULL,
+                        stage TEXT NOT NULL,
+                        ext TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        hash TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_stage_ext ON files (stage, ext)')
+    conn.execute('COMMIT')
+    return conn
+
+
+def content_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_directory(path, known_mtime=None):
+    '''
+    List a directory unless its mtime is known_mtime.
+    Returns (mtime_ns, subdirs, files) with files as (path, size, mtime_ns),
+    subdirs and files are None for an unchanged directory, mtime_ns is None for a missing one.
+    '''
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None, None, None
+    if mtime == known_mtime:
+        return mtime, None, None
+
+    subdirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:  # removed during the scan
+                continue
+    return mtime, subdirs, files
+
+
+def delete_tree(conn, path):
+    # paths under path/ sort between 'path/' and 'path0' ('0' follows '/')
+    low, high = path + os.sep, path + chr(ord(os.sep) + 1)
+    conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+    conn.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)', (path, low, high))
+
+
+def write_directory(conn, path, parent, stage, mtime, subdirs, files, now_ns):
+    stored_mtime = -1 if now_ns - mtime < RACY_SECONDS * 10 ** 9 else mtime
+    conn.execute('INSERT OR REPLACE INTO dirs (path, parent, stage, mtime_ns) VALUES (?, ?, ?, ?)',
+                 (path, parent, stage, stored_mtime))
+    current = set(subdirs)
+    for (old_dir,) in conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,)).fetchall():
+        if old_dir not in current:
+            delete_tree(conn, old_dir)
+
+    stored = {row[0]: row[1:] for row in
+              conn.execute('SELECT path, size, mtime_ns, hash FROM files WHERE dir = ?', (path,))}
+    current = {p for p, _, _ in files}
+    conn.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in stored if p not in current])
+    rows = []
+    for file_path, size, file_mtime in files:
+        old = stored.get(file_path)
+        file_hash = old[2] if old is not None and old[:2] == (size, file_mtime) else None
+        rows.append((file_path, path, stage, os.path.splitext(file_path)[1], size, file_mtime, file_hash))
+    conn.executemany('INSERT OR REPLACE INTO files (path, dir, stage, ext, size, mtime_ns, hash) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def refresh(conn, root, stage, num_workers=DEFAULT_WORKERS, full=False, hash_contents=False):
+    '''
+    Bring the catalog of root up to date, returns the number of directories listed again.
+    With hash_contents, the files without hash (new or modified) are hashed.
+    '''
+    root = os.path.normpath(root)
+    known = {} if full else dict(conn.execute('SELECT path, mtime_ns FROM dirs WHERE stage = ?', (stage,)))
+    now_ns = time.time_ns()
+    rescanned = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        frontier = [(root, None)]
+        while frontier:
+            results = zip(frontier, executor.map(lambda d: scan_directory(d[0], known.get(d[0])), frontier))
+            next_frontier = []
+            # one short write transaction per batch of scanned directories, so that other
+            # connections (pipeline stages refreshing at the same time) are not locked out for the walk
+            while True:
+                batch = list(itertools.islice(results, WRITE_BATCH))
+                if not batch:
+                    break
+                conn.execute('BEGIN IMMEDIATE')
+                for (path, parent), (mtime, subdirs, files) in batch:
+                    if mtime is None:
+                        delete_tree(conn, path)
+                        continue
+                    if subdirs is None:  # unchanged, visit the subdirectories from the catalog
+                        next_frontier += [(row[0], path) for row in
+                                          conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+                        continue
+
+                    rescanned += 1
+                    write_directory(conn, path, parent, stage, mtime, subdirs, files, now_ns)
+                    next_frontier += [(subdir, path) for subdir in subdirs]
+                conn.execute('COMMIT')
+            frontier = next_frontier
+
+    if hash_contents:
+        paths = [row[0] for row in conn.execute('SELECT path FROM files WHERE stage = ? AND hash IS NULL',
+                                                (stage,))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            hashes = list(executor.map(content_hash, paths))
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('UPDATE files SET hash = ? WHERE path = ?', zip(hashes, paths))
+        conn.execute('COMMIT')
+    return rescanned
+
+
+def get_files(conn, stage=None, ext=None, columns=('path',)):
+    '''
+    Files of a stage (or all stages) with the given extension(s), sorted by path.
+    Returns the paths, or tuples when several columns are requested.
+    '''
+    allowed = ('path', 'dir', 'stage', 'ext', 'size', 'mtime_ns', 'hash')
+    if any(column not in allowed for column in columns):
+        raise ValueError(f'Unknown column in {columns}')
+    conditions, params = [], []
+    if stage is not None:
+        conditions.append('stage = ?')
+        params.append(stage)
+    if ext is not None:
+        extensions = [ext] if isinstance(ext, str) else list(ext)
+        conditions.append(f'ext IN ({", ".join("?" * len(extensions))})')
+        params += extensions
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    rows = conn.execute(f'SELECT {", ".join(columns)} FROM files{where} ORDER BY path', params)
+    return [row[0] for row in rows] if len(columns) == 1 else rows.fetchall()
@@ -0,0 +1,117 @@
+from tokens_to_musicxml import expand_tokens, key_fifths, parse_hand
+from create_vocab import Vocabulary
+
+"""
+Incremental detokenizer for live generation
+
+IncrementalDecoder accepts token IDs one at a time or in chunks, as the
+model produces them, and returns every measure as soon as it is complete:
+when the next bar token of the same hand arrives, when the left hand
+starts (last right hand measure) or when finish() is called.
+
+A measure is a dict: hand ('R' or 'L'), number (from 0), tokens (expanded
+like tokens_to_score.concatenated_to_regular, without the bar token) and
+fifths (key signature in effect at the start of the measure).
+It can be turned into the items of tokens_to_musicxml.parse_hand with
+measure_to_items or into a music21 Measure with measure_to_music21.
+"""
+
+
+def measure_fifths(tokens, fifths):
+    '''
+    Key signature in effect at the end of a measure, with the same key_natural
+    workaround as tokens_to_score.tokens_to_PartStaff
+    '''
+    for i, t in enumerate(tokens):
+        if not t.startswith('key'):
+            continue
+        if t[:11] == 'key_natural' and i + 1 < len(tokens) and tokens[i + 1].startswith('key'):
+            continue
+        fifths = key_fifths(t)
+    return fifths
+
+
+class IncrementalDecoder:
+    '''
+    Per-hand decoding state: current hand, open measure and key signature
+    '''
+
+    def __init__(self, vocab):
+        if isinstance(vocab, str):
+            vocab = Vocabulary.from_file(vocab)
+        elif not isinstance(vocab, Vocabulary):
+            vocab = Vocabulary(vocab)
+        self.vocab = vocab
+        self.reset()
+
+    def reset(self):
+        self.hand = None
+        self.open_measure = None
+        self.numbers = {'R': 0, 'L': 0}
+        self.fifths = {'R': 0, 'L': 0}
+        self.finished = False
+
+    def feed(self, ids):
+        '''
+        Add a token ID or an iterable of token IDs, returns the measures completed by them
+        '''
+        if not hasattr(ids, '__iter__'):
+            ids = [ids]
+        return self.feed_tokens(self.vocab.decode(ids))
+
+    def feed_tokens(self, tokens):
+        if self.finished:
+            raise ValueError('The sequence is already finished, call reset() first')
+
+        completed = []
+        for t in expand_tokens(tokens):
+            if t in ('R', 'L'):
+                self.close_measure(completed)
+                self.hand = t
+            elif self.hand is None:  # difficulty token or tokens before R
+                continue
+            elif t == 'bar':
+                self.close_measure(completed)
+                self.open_measure = []
+            elif self.open_measure is not None:
+                self.open_measure.append(t)
+        return completed
+
+    def finish(self):
+        '''
+        End of the sequence, returns the last open measure (if any)
+        '''
+        completed = []
+        self.close_measure(completed)
+        self.finished = True
+        return completed
+
+    def close_measure(self, completed):
+        if self.open_measure is None:
+            return
+        hand = self.hand
+        measure = {
+            'hand': hand,
+            'number': self.numbers[hand],
+            'tokens': self.open_measure,
+            'fifths': self.fifths[hand],
+        }
+        self.numbers[hand] += 1
+        self.fifths[hand] = measure_fifths(self.open_measure, self.fifths[hand])
+        self.open_measure = None
+        completed.append(measure)
+
+
+def measure_to_items(measure):
+    return parse_hand(['bar'] + measure['tokens'], measure['fifths'])[0]
+
+
+def measure_to_music21(measure):
+    '''
+    music21 Measure decoded like the measures of tokens_to_score.tokens_to_score
+    '''
+    from tokens_to_score import tokens_to_PartStaff
+    part = tokens_to_PartStaff(['bar'] + measure['tokens'], key_=measure['fifths'], start_voice=0)
+    m = part.getElementsByClass('Measure')[0]
+    m.number = measure['number'] + 1
+    return m
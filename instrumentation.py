@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import zlib
+import cProfile
+import argparse
+import resource
+import contextlib
+
+"""
+Performance trace of the data pipeline
+
+configure(trace) enables the trace, a JSONL file receiving one event per
+line (appended with a single os.write, so that worker processes and
+threads can share it):
+
+- {"type": "stage", "stage", "wall", "cpu", "peak_rss_kb", "items", ...}
+  written by the stage() context manager: wall and CPU time (including
+  the worker processes that ended during the stage) and the peak RSS
+- {"type": "file", "stage", "path", "seconds", "ok"} written for every
+  call of a function wrapped with traced(), ok is False when the call
+  raised or when its result is a failure for the failed predicate
+
+CPU time and peak RSS are those of the whole process: stages running at
+the same time in one process (pipeline.py --workers) share them.
+
+With a profile rate, traced() runs a deterministic sample of the files
+(same files on every run) under cProfile and dumps the statistics in the
+profile directory. When the trace is disabled, traced() returns the
+function unchanged and stage() only yields its record.
+
+Summary of a trace: python instrumentation.py data/trace.jsonl
+"""
+
+config = {'trace': None, 'profile_rate': 0.0, 'profile_dir': None}
+SAMPLE_RANGE = 10 ** 6
+
+
+def configure(trace=None, profile_rate=0.0, profile_dir=None):
+    if trace and os.path.dirname(trace):
+        os.makedirs(os.path.dirname(trace), exist_ok=True)
+    if profile_rate and profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    config.update(trace=trace or None, profile_rate=profile_rate if profile_dir else 0.0,
+                  profile_dir=profile_dir)
+
+
+def add_arguments(parser):
+    parser.add_argument('--trace', default=None, type=str,
+                        help='JSONL file receiving the timing of every stage and file')
+    parser.add_argument('--profile_rate', default=0.0, type=float,
+                        help='Fraction of the traced files run under cProfile')
+    parser.add_argument('--profile_dir', default='./data/profiles', type=str,
+                        help='Directory of the cProfile statistics')
+
+
+def write_event(event, trace=None):
+    trace = trace or config['trace']
+    if trace is None:
+        return
+    line = (json.dumps(event) + '\n').encode('utf-8')
+    fd = os.open(trace, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_kb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+@contextlib.contextmanager
+def stage(name, items=None):
+    '''
+    Record the wall/CPU time and peak RSS of the block,
+    the number of items can be set in the yielded record
+    '''
+    record = {'type': 'stage', 'stage': name, 'items': items, 'pid': os.getpid(), 'start': time.time()}
+    start, start_cpu = time.perf_counter(), cpu_time()
+    try:
+        yield record
+        record['ok'] = True
+    except BaseException:
+        record['ok'] = False
+        raise
+    finally:
+        if config['trace'] is not None:
+            record['wall'] = time.perf_counter() - start
+            record['cpu'] = cpu_time() - start_cpu
+            record['peak_rss_kb'] = peak_rss_kb()
+            write_event(record)
+
+
+def sampled(path, rate):
+    return rate > 0 and zlib.crc32(str(path).encode('utf-8')) % SAMPLE_RANGE < rate * SAMPLE_RANGE
+
+
+class Traced:
+    '''
+    Picklable wrapper of func(path, ...) writing a file event per call,
+    the trace configuration is copied so that it reaches the worker processes.
+    failed(result) detects the failures of functions returning them instead of
+    raising, it must be picklable (a module-level function).
+    '''
+    def __init__(self, stage, func, failed=None):
+        self.stage = stage
+        self.func = func
+        self.failed = failed
+        self.config = dict(config)
+
+    def __call__(self, path, *args, **kwargs):
+        profiler = None
+        if sampled(path, self.config['profile_rate']):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = self.func(path, *args, **kwargs)
+            ok = self.failed is None or not self.failed(result)
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                name = f'{self.stage}-{os.path.basename(str(path))}-{zlib.crc32(str(path).encode("utf-8")):08x}.prof'
+                profiler.dump_stats(os.path.join(self.config['profile_dir'], name))
+            write_event({'type': 'file', 'stage': self.stage, 'path': str(path),
+                         'seconds': seconds, 'ok': ok}, self.config['trace'])
+
+
+def traced(stage, func, failed=None):
+    return Traced(stage, func, failed) if config['trace'] is not None else func
+
+
+def is_none(result):
+    '''
+    failed predicate of the functions returning None for a rejected file
+    '''
+    return result is None
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def summarize(events, top=10):
+    '''
+    Per stage: runs, wall, CPU, peak RSS, items and throughput, file latency percentiles.
+    Returns the stage summaries and the slowest files.
+    '''
+    stages = {}
+    for event in events:
+        summary = stages.setdefault(event['stage'], {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_kb': 0,
+                                                     'items': 0, 'files': [], 'failed': 0})
+        if event['type'] == 'stage':
+            summary['runs'] += 1
+            summary['wall'] += event['wall']
+            summary['cpu'] += event['cpu']
+            summary['peak_rss_kb'] = max(summary['peak_rss_kb'], event['peak_rss_kb'])
+            summary['items'] += event.get('items') or 0
+        elif event['type'] == 'file':
+            summary['files'].append(event['seconds'])
+            summary['failed'] += not event['ok']
+
+    for summary in stages.values():
+        latencies = summary.pop('files')
+        if not summary['items']:
+            summary['items'] = len(latencies)
+        summary['items_per_s'] = summary['items'] / summary['wall'] if summary['wall'] and summary['items'] else None
+        summary['traced_files'] = len(latencies)
+        summary.update({f'p{int(q * 100)}': percentile(latencies, q) for q in (0.5, 0.9, 0.99)})
+
+    files = [event for event in events if event['type'] == 'file']
+    slowest = sorted(files, key=lambda event: event['seconds'], reverse=True)[:top]
+    return stages, slowest
+
+
+def print_summary(stages, slowest):
+    print(f"{'stage':<24}{'runs':>5}{'wall s':>10}{'cpu s':>10}{'rss MB':>9}{'items':>9}{'items/s':>10}"
+          f"{'p50 s':>9}{'p90 s':>9}{'p99 s':>9}{'failed':>8}")
+    for name, s in sorted(stages.items(), key=lambda item: item[1]['wall'], reverse=True):
+        rate = f"{s['items_per_s']:.2f}" if s['items_per_s'] is not None else '-'
+        print(f"{name:<24}{s['runs']:>5}{s['wall']:>10.1f}{s['cpu']:>10.1f}{s['peak_rss_kb'] / 1024:>9.0f}"
+              f"{s['items']:>9}{rate:>10}{s['p50']:>9.3f}{s['p90']:>9.3f}{s['p99']:>9.3f}{s['failed']:>8}")
+    if slowest:
+        print('\nSlowest files:')
+        for event in slowest:
+            print(f"{event['seconds']:>9.3f}s  {event['stage']:<20} {event['path']}"
+                  f"{'' if event['ok'] else '  (failed)'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summary of a pipeline trace')
+    parser.add_argument('trace', help='JSONL trace written with --trace')
+    parser.add_argument('--top', default=10, type=int, help='Number of slowest files to show')
+    parser.add_argument('--stage', default=None, type=str, help='Only show this stage')
+    args = parser.parse_args()
+
+    events = read_trace(args.trace)
+    if args.stage is not None:
+        events = [event for event in events if event['stage'] == args.stage]
+    if not events:
+        print('Empty trace')
+        sys.exit(1)
+    print_summary(*summarize(events, args.top))
+
+
+if __name__ == '__main__':
+    main()
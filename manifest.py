@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+
+"""
+Persistent manifest of the processing pipeline
+
+One row per MuseScore input with its MusicXML output and its status:
+- pending: to convert
+- converted: MusicXML written
+- filtered: kept by filter_empty
+- tokenized: tokenized without error
+- failed: discarded, reason tells the stage and the error
+
+The manifest is a SQLite database (WAL mode, like the token cache) indexed
+on status and on the MusicXML path and file name, so every stage queries
+the files it still has to process and an interrupted run resumes with the
+remaining work only.
+"""
+
+PENDING, CONVERTED, FILTERED, TOKENIZED, FAILED = 'pending', 'converted', 'filtered', 'tokenized', 'failed'
+STATUSES = (PENDING, CONVERTED, FILTERED, TOKENIZED, FAILED)
+
+
+def musicxml_path(path):
+    return os.path.splitext(path)[0] + '.musicxml'
+
+
+def open_manifest(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        musicxml TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        reason TEXT,
+                        updated REAL NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_status ON files (status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_musicxml ON files (musicxml)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_name ON files (name)')
+    conn.execute('COMMIT')
+    return conn
+
+
+def add_inputs(conn, paths):
+    '''
+    Register MuseScore inputs as pending, inputs already in the manifest keep their status
+    '''
+    now = time.time()
+    rows = [(p, musicxml_path(p), os.path.basename(musicxml_path(p)), PENDING, now) for p in paths]
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT OR IGNORE INTO files (path, musicxml, name, status, updated) '
+                     'VALUES (?, ?, ?, ?, ?)', rows)
+    conn.execute('COMMIT')
+
+
+def set_status(conn, keys, status, reason=None, by='path'):
+    '''
+    Set the status of the rows whose column by ('path', 'musicxml' or 'name') is in keys.
+    reason is a string or a list with one reason per key.
+    '''
+    if status not in STATUSES:
+        raise ValueError(f'Unknown status {status}')
+    if by not in ('path', 'musicxml', 'name'):
+        raise ValueError(f'Cannot select files by {by}')
+    keys = list(keys)
+    reasons = reason if isinstance(reason, list) else [reason] * len(keys)
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(f'UPDATE files SET status = ?, reason = ?, updated = ? WHERE {by} = ?',
+                     [(status, r, now, k) for k, r in zip(keys, reasons)])
+    conn.execute('COMMIT')
+
+
+def get_files(conn, status=None, column='path'):
+    '''
+    Values of column for the files with the given status (or all files)
+    '''
+    if column not in ('path', 'musicxml', 'name'):
+        raise ValueError(f'Unknown column {column}')
+    if status is None:
+        rows = conn.execute(f'SELECT {column} FROM files ORDER BY path')
+    else:
+        statuses = [status] if isinstance(status, str) else list(status)
+        rows = conn.execute(f'SELECT {column} FROM files WHERE status IN '
+                            f'({", ".join("?" * len(statuses))}) ORDER BY path', statuses)
+    return [row[0] for row in rows]
+
+
+def get_failures(conn):
+    return conn.execute('SELECT path, reason FROM files WHERE status = ? ORDER BY path',
+                        (FAILED,)).fetchall()
+
+
+def status_counts(conn):
+    return dict(conn.execute('SELECT status, COUNT(*) FROM files GROUP BY status').fetchall())
+
+
+def sync_converted(conn, existing=None):
+    '''
+    Mark pending inputs whose MusicXML output already exists as converted
+    (outputs written by an interrupted run). existing is the set of the
+    MusicXML files on disk if known, otherwise every output is checked.
+    '''
+    rows = conn.execute('SELECT path, musicxml FROM files WHERE status = ?', (PENDING,)).fetchall()
+    if existing is None:
+        done = [path for path, output in rows if os.path.exists(output)]
+    else:
+        done = [path for path, output in rows if output in existing]
+    set_status(conn, done, CONVERTED)
+    return len(done)
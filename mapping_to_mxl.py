@@ -1,8 +1,19 @@
 import os
 import glob
+import time
 import argparse
+import concurrent.futures
+from functools import partial
 from tqdm import tqdm
-from tokens_to_score import tokens_to_score
+from tokens_to_score import tokens_to_score, compile_vocab, ids_to_score
+from tokens_to_musicxml import write_musicxml
+from tokens_to_midi import write_midi
+from create_vocab import Vocabulary
+from batch_tokenize import write_failure_manifest
+
+# vocabulary and parse table of the worker processes, loaded once per process
+worker_vocab = None
+worker_table = None
 
 
 def dir_path(string):
@@ -23,7 +34,7 @@ def parse_args():
     )
 
     parser.add_argument(
-        '-o'
+        '-o',
         '--output',
         dest='output',
         type=str,
@@ -40,12 +51,145 @@ def parse_args():
         default='data/score_transformers_vocab.txt'
     )
 
+    parser.add_argument(
+        '--fast',
+        action='store_true',
+        help='Write the MusicXML directly from the tokens instead of building a music21 score'
+    )
+
+    parser.add_argument(
+        '--midi',
+        action='store_true',
+        help='Render MIDI files with pretty_midi instead of MusicXML'
+    )
+
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Decode each prediction line as its own sample into the output directory'
+    )
+
+    parser.add_argument(
+        '--separator',
+        type=str,
+        default=None,
+        help='With --batch, token ID separating samples instead of line breaks'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of decoding processes for --batch'
+    )
+
+    parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=8,
+        help='Number of samples sent to a worker at a time'
+    )
+
     return parser.parse_args()
 
 
+def read_samples(preds, separator=None):
+    '''
+    (index, token IDs) per non-empty line, or per separator-delimited sequence.
+    The index is the line (sequence) number, empty ones are skipped after numbering.
+    '''
+    with open(preds, "r") as file:
+        if separator is None:
+            samples = [line.split() for line in file]
+        else:
+            samples = [[]]
+            for t in file.read().split():
+                if t == separator:
+                    samples.append([])
+                else:
+                    samples[-1].append(t)
+    return [(index, ids) for index, ids in enumerate(samples) if ids]
+
+
+def init_worker(vocab_path):
+    global worker_vocab, worker_table
+    worker_vocab = Vocabulary.from_file(vocab_path)
+    worker_table = compile_vocab(worker_vocab.id_to_token)
+
+
+def decode_sample(sample, output_dir, fast=False, midi=False, vocab=None, table=None):
+    '''
+    Decode one (index, IDs) sample to output_dir/sample_XXXXX.musicxml (.mid),
+    returns (index, output path, failure)
+    '''
+    index, ids = sample
+    vocab = vocab or worker_vocab
+    table = table or worker_table
+    path = os.path.join(output_dir, f'sample_{index:05d}' + ('.mid' if midi else '.musicxml'))
+    start = time.perf_counter()
+    try:
+        ids = [int(i) for i in ids]
+        if midi:
+            write_midi(' '.join(vocab.decode(ids)), path)
+        elif fast:
+            write_musicxml(' '.join(vocab.decode(ids)), path)
+        else:
+            ids_to_score(ids, table).write('musicxml', path)
+    except Exception as e:
+        failure = {
+            'sample': index,
+            'error': type(e).__name__,
+            'message': str(e),
+            'time': time.perf_counter() - start,
+        }
+        return index, None, failure
+    return index, path, None
+
+
+def decode_batch(samples, output_dir, vocab_path, num_workers=os.cpu_count(), chunksize=8, fast=False,
+                 midi=False):
+    '''
+    Decode the (index, IDs) samples across num_workers processes, each worker loads the
+    vocabulary once. Returns the output paths in sample order (None for failed samples)
+    and the failures.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    paths, failures = [], []
+
+    if num_workers is None or num_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers, initializer=init_worker, initargs=(vocab_path,))
+        outputs = executor.map(partial(decode_sample, output_dir=output_dir, fast=fast, midi=midi),
+                               samples, chunksize=chunksize)
+    else:  # run in the main process
+        executor = None
+        vocab = Vocabulary.from_file(vocab_path)
+        outputs = map(partial(decode_sample, output_dir=output_dir, fast=fast, midi=midi, vocab=vocab,
+                              table=compile_vocab(vocab.id_to_token)), samples)
+
+    try:
+        for _, path, failure in tqdm(outputs, 'Decoding', total=len(samples)):
+            if failure is not None:
+                failures.append(failure)
+            paths.append(path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return paths, failures
+
+
 def main():
     args = parse_args()
 
+    if args.batch:
+        samples = read_samples(args.preds, args.separator)
+        _, failures = decode_batch(samples, args.output, args.vocab, args.workers,
+                                   args.chunksize, args.fast, args.midi)
+        write_failure_manifest(failures, os.path.join(args.output, 'failures.jsonl'))
+        print(f'{len(samples) - len(failures)}/{len(samples)} samples decoded to {args.output}')
+        return
+
     unique_tokens = []
     with open(args.vocab, "r") as file:
         for line in file:
@@ -60,8 +204,13 @@ def main():
         score_representation[i] = unique_tokens[int(score_representation[i])]
 
     score_string = ' '.join(score_representation)
-    score = tokens_to_score(score_string)
-    score.write('musicxml', 'generated_score')
+    if args.midi:
+        write_midi(score_string, 'generated_score.mid')
+    elif args.fast:
+        write_musicxml(score_string, 'generated_score.musicxml')
+    else:
+        score = tokens_to_score(score_string)
+        score.write('musicxml', 'generated_score')
 
 
 if __name__ == "__main__":
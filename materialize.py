@@ -0,0 +1,100 @@
+import os
+import errno
+import shutil
+import tempfile
+import concurrent.futures
+from tqdm import tqdm
+
+"""
+Materialization of a dataset directory from files stored elsewhere
+
+- copy: real copies, made by a pool of threads
+- hardlink: no data written, the dataset files share the inodes of the
+  originals (same filesystem only)
+- reflink: copy-on-write clone (FICLONE ioctl, btrfs/XFS/...), no data
+  written until one side is modified
+- auto: reflink, else hardlink, else copy, decided per file
+- manifest: nothing is written, later stages read the original paths
+
+Hardlinked files are the originals: they must not be modified in place.
+"""
+
+MODES = ('copy', 'hardlink', 'reflink', 'auto', 'manifest')
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+# errors meaning the filesystem cannot link or clone this file, fall back to the next method
+UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EMLINK,
+               errno.ENOSYS}
+
+
+def replace_with(dst, create):
+    '''
+    Create a temporary file next to dst with create(tmp_path) and move it onto dst
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix='.materialize-')
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        create(tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def reflink(src, dst):
+    import fcntl
+
+    def clone(tmp_path):
+        with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, tmp_path)
+    replace_with(dst, clone)
+
+
+def hardlink(src, dst):
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    replace_with(dst, lambda tmp_path: os.link(src, tmp_path))
+
+
+def copy(src, dst):
+    replace_with(dst, lambda tmp_path: shutil.copy(src, tmp_path))
+
+
+METHODS = {'reflink': reflink, 'hardlink': hardlink, 'copy': copy}
+FALLBACKS = {'auto': ('reflink', 'hardlink', 'copy')}
+
+
+def materialize_file(src, dst, mode='copy'):
+    '''
+    Create dst from src with the given mode, returns the method used
+    '''
+    methods = FALLBACKS.get(mode, (mode,))
+    for method in methods:
+        try:
+            METHODS[method](src, dst)
+            return method
+        except OSError as e:
+            if method == methods[-1] or e.errno not in UNSUPPORTED:
+                raise
+
+
+def materialize(paths, output_dir, mode='copy', num_workers=os.cpu_count()):
+    '''
+    Materialize paths into output_dir, returns the path every file is read from
+    (the original for the manifest mode) and the count of files per method
+    '''
+    if mode not in MODES:
+        raise ValueError(f'Unknown materialization mode {mode}, modes are {MODES}')
+    if mode == 'manifest':
+        return [os.path.abspath(path) for path in paths], {'manifest': len(paths)}
+
+    os.makedirs(output_dir, exist_ok=True)
+    targets = [os.path.join(output_dir, os.path.basename(path)) for path in paths]
+    counts = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        methods = executor.map(lambda item: materialize_file(item[0], item[1], mode), zip(paths, targets))
+        for method in tqdm(methods, f'Materializing dataset ({mode})', total=len(paths)):
+            counts[method] = counts.get(method, 0) + 1
+    return targets, counts
@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import sqlite3
+from tqdm import tqdm
+
+"""
+On-disk index of the MuseScore metadata (score.jsonl)
+
+The JSONL file is ingested once into a SQLite table keyed by score id,
+holding only the fields the pipeline needs. The byte offset of the last
+ingested line is stored with the index: when the JSONL file grows, only
+the new lines are read; when its beginning changed, the index is rebuilt.
+The beginning is the hash of the first ingested bytes (at most HEAD_SIZE),
+stored with its length, so appending to a small file keeps the index.
+
+Lookups are batched (lookup) and the scores can be selected with an SQL
+condition and/or any Python predicate on the stored fields (select_ids).
+"""
+
+# index column -> score.jsonl key, missing keys are stored as NULL
+FIELDS = {
+    'instruments': 'instrumentsNames',
+    'parts': 'partsCount',
+    'pages': 'pagesCount',
+}
+HEAD_SIZE = 4096
+BATCH_SIZE = 10000
+PIANO_INSTRUMENTS = (['Piano'], ['piano'])
+
+
+def default_index_path(metadata):
+    return os.path.splitext(metadata)[0] + '_index.sqlite'
+
+
+def file_head(metadata, length=HEAD_SIZE):
+    with open(metadata, 'rb') as f:
+        return hashlib.sha1(f.read(length)).hexdigest()
+
+
+def open_index(path):
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('BEGIN IMMEDIATE')
+    columns = ''.join(f', {column}' for column in FIELDS)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS scores (id TEXT PRIMARY KEY{columns})')
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                        name TEXT PRIMARY KEY,
+                        value TEXT NOT NULL)''')
+    conn.execute('COMMIT')
+    return conn
+
+
+def get_meta(conn, name, default=None):
+    row = conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return row[0] if row is not None else default
+
+
+def set_meta(conn, name, value):
+    conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, str(value)))
+
+
+def record_to_row(data):
+    row = [str(data['id'])]
+    for key in FIELDS.values():
+        value = data.get(key)
+        row.append(json.dumps(value) if isinstance(value, (list, dict)) else value)
+    return row
+
+
+def insert_rows(conn, rows, offset):
+    columns = ', '.join(['id'] + list(FIELDS))
+    placeholders = ', '.join('?' * (len(FIELDS) + 1))
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(f'INSERT OR REPLACE INTO scores ({columns}) VALUES ({placeholders})', rows)
+    set_meta(conn, 'offset', offset)
+    conn.execute('COMMIT')
+
+
+def build_index(metadata, index_path=None):
+    '''
+    Create or update the index of metadata, returns the index connection
+    '''
+    conn = open_index(index_path or default_index_path(metadata))
+    size = os.path.getsize(metadata)
+    offset = int(get_meta(conn, 'offset', 0))
+    head_size = int(get_meta(conn, 'head_size', 0))
+
+    if offset > size or get_meta(conn, 'head') != file_head(metadata, head_size):  # new or rewritten file
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM scores')
+        set_meta(conn, 'head', file_head(metadata, 0))
+        set_meta(conn, 'head_size', 0)
+        set_meta(conn, 'offset', 0)
+        conn.execute('COMMIT')
+        offset = head_size = 0
+    if offset == size:
+        return conn
+
+    rows = []
+    with open(metadata, 'rb') as f, tqdm(total=size - offset, desc='Indexing metadata',
+                                         unit='B', unit_scale=True) as progress:
+        f.seek(offset)
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                if not line.endswith(b'\n'):  # line still being written
+                    break
+                data = {}
+            offset += len(line)
+            progress.update(len(line))
+            if isinstance(data, dict) and 'id' in data:
+                rows.append(record_to_row(data))
+            if len(rows) >= BATCH_SIZE:
+                insert_rows(conn, rows, offset)
+                rows = []
+    insert_rows(conn, rows, offset)
+
+    if head_size < min(HEAD_SIZE, offset):
+        conn.execute('BEGIN IMMEDIATE')
+        set_meta(conn, 'head', file_head(metadata, min(HEAD_SIZE, offset)))
+        set_meta(conn, 'head_size', min(HEAD_SIZE, offset))
+        conn.execute('COMMIT')
+    return conn
+
+
+def row_to_dict(row):
+    record = {'id': row[0]}
+    for column, value in zip(FIELDS, row[1:]):
+        record[column] = json.loads(value) if column == 'instruments' and value is not None else value
+    return record
+
+
+def lookup(conn, ids, batch_size=900):
+    '''
+    Records of the given ids as a dict id -> record, ids missing from the index are left out
+    '''
+    ids = [str(i) for i in ids]
+    columns = ', '.join(['id'] + list(FIELDS))
+    records = {}
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        rows = conn.execute(f'SELECT {columns} FROM scores WHERE id IN ({", ".join("?" * len(batch))})',
+                            batch)
+        for row in rows:
+            records[row[0]] = row_to_dict(row)
+    return records
+
+
+def select_ids(conn, where=None, params=(), predicate=None):
+    '''
+    Ids of the scores matching the SQL condition where and the Python predicate(record)
+    '''
+    columns = ', '.join(['id'] + list(FIELDS))
+    query = f'SELECT {columns} FROM scores' + (f' WHERE {where}' if where else '')
+    ids = []
+    for row in conn.execute(query, params):
+        if predicate is None or predicate(row_to_dict(row)):
+            ids.append(row[0])
+    return ids
+
+
+def is_piano_record(record):
+    return record['instruments'] in PIANO_INSTRUMENTS
+
+
+def file_id(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
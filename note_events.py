@@ -0,0 +1,77 @@
+import numpy as np
+from score_to_tokens_stream import MusicXML_to_events
+
+"""
+Pitch lists and complexity derived from note event arrays
+
+The note event array of a score (score_to_tokens_stream.MusicXML_to_events)
+is extracted with the lxml parser of the streaming tokenizer, without
+music21. MusicXML_to_tokens_stream(with_events=True) returns the tokens and
+the events of one pass; the pipeline reads pitches (before deduplication)
+and tokens (after) in different stages, so it parses the score in each.
+The functions below replace the music21 based
+similarity.get_piano_pitches and split_musicXML.compute_complexity.
+"""
+
+
+def hand_events(events, is_right_hand=True):
+    return events[events['staff'] == (1 if is_right_hand else 2)]
+
+
+def events_to_pitches(events):
+    '''
+    MIDI pitches in music21 flatten() order: by onset, then by voice (music21 creates
+    the voices of a measure sorted by their number as a string), then score order.
+    Onsets are rounded to 1/1000 of a quarter: inexact tuplet durations leave
+    voices slightly apart where music21 has them at the same offset.
+    '''
+    voices = np.unique(events['voice'])
+    rank = np.empty(int(voices.max()) + 1 if len(voices) else 0, dtype=np.int64)
+    rank[voices] = np.argsort(np.argsort([str(v) for v in voices]))
+    order = np.lexsort((np.arange(len(events)), rank[events['voice']], np.round(events['onset'], 3)))
+    return events['pitch'][order]
+
+
+def events_complexity(events):
+    '''
+    Number of notes (a chord counts once) over their total duration,
+    chord durations being divided by the number of pitches, averaged over both hands
+    '''
+    complexity_values = []
+    for staff in (2, 1):
+        hand = events[events['staff'] == staff]
+        if not len(hand):
+            complexity_values.append(0)
+            continue
+
+        chords, first, n_pitches = np.unique(
+            hand['chord'], return_index=True, return_counts=True)
+        durations = hand['duration'][first].astype(np.float64) / n_pitches
+        total = durations.sum()
+        complexity_values.append(len(chords) / total if total else np.inf)
+
+    return np.mean(complexity_values)
+
+
+def fragment_events(events, start_measure, n_measures):
+    measures = events['measure']
+    return events[(measures >= start_measure) & (measures < start_measure + n_measures)]
+
+
+def get_piano_pitches(path, is_right_hand=True):
+    '''
+    Same contract as similarity.get_piano_pitches: (path, pitches) or None
+    '''
+    try:
+        events = MusicXML_to_events(path)
+    except Exception:
+        return None
+
+    pitches = events_to_pitches(hand_events(events, is_right_hand))
+    if len(pitches) == 0:
+        return None
+    return (path, pitches.tolist())
+
+
+def compute_complexity(path):
+    return events_complexity(MusicXML_to_events(path))
@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import numpy as np
+import torch
+from tqdm import tqdm
+
+"""
+Packed dataset format for the mapped fragments
+
+A dataset directory holds:
+- dataset.json: vocabulary size, ID dtype and the list of shards
+- vocab.txt: the vocabulary the IDs refer to
+- shard_XXXXX.ids.npy: the token IDs of all the samples of the shard, flat
+- shard_XXXXX.index.npy: one record per sample (offset, length, difficulty ID, fragment number)
+- shard_XXXXX.paths.txt: the source path of each sample, one per line
+
+The .npy files are memory-mapped, so a sample is read without loading the shard.
+"""
+
+DEFAULT_SHARD_SIZE = 100000
+
+index_dtype = np.dtype([('offset', np.int64), ('length', np.int32),
+                        ('difficulty', np.int32), ('fragment', np.int32)])
+
+
+def get_fragment_number(path):
+    match = re.search(r'_fragment_(\d+)', os.path.basename(path))
+    return int(match.group(1)) if match else -1
+
+
+def write_shard(output_dir, shard_id, samples, dtype):
+    '''
+    samples: list of (path, ids array, difficulty ID)
+    '''
+    name = os.path.join(output_dir, f'shard_{shard_id:05d}')
+    index = np.zeros(len(samples), dtype=index_dtype)
+    offset = 0
+    for i, (path, ids, difficulty) in enumerate(samples):
+        index[i] = (offset, len(ids), difficulty, get_fragment_number(path))
+        offset += len(ids)
+
+    if samples:
+        ids = np.concatenate([ids for _, ids, _ in samples]).astype(dtype)
+    else:
+        ids = np.zeros(0, dtype=dtype)
+    np.save(name + '.ids.npy', ids)
+    np.save(name + '.index.npy', index)
+    with open(name + '.paths.txt', 'w') as f:
+        for path, _, _ in samples:
+            f.write(path + '\n')
+
+    return {'name': os.path.basename(name), 'samples': len(samples), 'tokens': int(offset)}
+
+
+def write_packed_dataset(output_dir, tokens_list, vocab, shard_size=DEFAULT_SHARD_SIZE):
+    '''
+    Pack (path, tokens) sequences into shards of shard_size samples.
+    The first token of a sequence is its difficulty token.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    samples = []
+    for path, tokens in tqdm(tokens_list, 'Packing dataset'):
+        ids = vocab.encode(tokens)
+        difficulty = vocab.token_to_id.get(tokens[0], -1)
+        samples.append((path, ids, difficulty))
+        if len(samples) == shard_size:
+            shards.append(write_shard(output_dir, len(shards), samples, vocab.dtype))
+            samples = []
+    if samples or not shards:
+        shards.append(write_shard(output_dir, len(shards), samples, vocab.dtype))
+
+    vocab.save(os.path.join(output_dir, 'vocab.txt'))
+    manifest = {
+        'vocab_size': len(vocab),
+        'dtype': np.dtype(vocab.dtype).name,
+        'shards': shards,
+    }
+    with open(os.path.join(output_dir, 'dataset.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    '''
+    Random access to a packed dataset. Shards are memory-mapped on first
+    access in each process, so the dataset can be shared with DataLoader
+    workers without copying the data. Samples are read-only views on the
+    shard, converted to tensors by collate (DataLoader(..., collate_fn=collate)).
+    '''
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        with open(os.path.join(dataset_dir, 'dataset.json')) as f:
+            self.manifest = json.load(f)
+
+        self.shard_names = [s['name'] for s in self.manifest['shards']]
+        self.cumulative = np.cumsum(
+            [0] + [s['samples'] for s in self.manifest['shards']])
+        self.shards = {}
+        self.paths = {}
+
+    def __len__(self):
+        return int(self.cumulative[-1])
+
+    def __getstate__(self):  # do not send memory maps to DataLoader workers
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            name = os.path.join(self.dataset_dir, self.shard_names[shard_id])
+            self.shards[shard_id] = (np.load(name + '.ids.npy', mmap_mode='r'),
+                                     np.load(name + '.index.npy', mmap_mode='r'))
+        return self.shards[shard_id]
+
+    def locate(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        shard_id = int(np.searchsorted(self.cumulative, idx, side='right')) - 1
+        return shard_id, idx - int(self.cumulative[shard_id])
+
+    def get_ids(self, idx):
+        '''
+        Token IDs of a sample as a read-only view on the memory-mapped shard
+        '''
+        shard_id, i = self.locate(idx)
+        ids, index = self.get_shard(shard_id)
+        offset, length = int(index[i]['offset']), int(index[i]['length'])
+        return ids[offset:offset + length]
+
+    def get_metadata(self, idx):
+        shard_id, i = self.locate(idx)
+        _, index = self.get_shard(shard_id)
+        if shard_id not in self.paths:
+            name = os.path.join(self.dataset_dir, self.shard_names[shard_id])
+            with open(name + '.paths.txt') as f:
+                self.paths[shard_id] = f.read().splitlines()
+        return {
+            'path': self.paths[shard_id][i],
+            'difficulty': int(index[i]['difficulty']),
+            'fragment': int(index[i]['fragment']),
+        }
+
+    def __getitem__(self, idx):
+        return self.get_ids(idx)
+
+
+def collate(samples, pad_id=0):
+    '''
+    Batch of PackedDataset samples: the ID views are copied once, into a padded
+    int64 tensor. Returns the batch and the length of each sample.
+    '''
+    lengths = [len(ids) for ids in samples]
+    batch = np.full((len(samples), max(lengths, default=0)), pad_id, dtype=np.int64)
+    for row, ids in zip(batch, samples):
+        row[:len(ids)] = ids
+    return torch.from_numpy(batch), torch.tensor(lengths, dtype=torch.int64)
@@ -0,0 +1,333 @@
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import threading
+import collections
+import concurrent.futures
+import file_catalog
+import manifest as pipeline_manifest
+import split_musicXML
+import materialize
+import instrumentation
+import columnar
+from process_musescore import (get_mscz_paths, get_musicxml_paths, filter_piano, mscz2musicxml,
+                               filter_empty, filter_with_manifest, load_difficulties, create_dataset,
+                               save_filtered_difficulties)
+from similarity import process_pitches, process_similarity
+from convert_pool import DEFAULT_COMMAND, DEFAULT_BATCH_SIZE, DEFAULT_TIMEOUT, MAX_TIMEOUT_FILES
+
+"""
+Pipeline runner over the stages of process_musescore and split_musicXML
+
+Each stage declares the stages it depends on, its input files and
+directories, its outputs and its parameters. Before running a stage its
+fingerprint is computed from its name, parameters, inputs and the
+fingerprints of the stages it depends on; the stage is skipped when the
+fingerprint matches the last successful run and its outputs exist. A
+changed parameter therefore reruns the stage and the stages after it only.
+Stages whose dependencies are done run at the same time.
+
+    process -> convert -> filter -> pitch -> similarity
+    dataset -> split -> vocab
+
+The fingerprints are kept in a JSON state file (--state).
+"""
+
+Stage = collections.namedtuple('Stage', ['name', 'func', 'deps', 'inputs', 'outputs', 'params'])
+# a directory input: the files of the catalog stage with the given extension
+DirInput = collections.namedtuple('DirInput', ['path', 'stage', 'ext'])
+
+HASH_LIMIT = 64 * 1024 ** 2  # larger files are fingerprinted by size and mtime
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the data pipeline, skipping up-to-date stages')
+    parser.add_argument('stages', nargs='*',
+                        help='Stages to run with the stages they depend on (default: all)')
+    parser.add_argument('--dir_path', default='~/Documents/upf/MuseScore', type=str,
+                        help='Path to directory containing Musescore files')
+    parser.add_argument('--metadata', default='./data/score.jsonl', type=str,
+                        help='Path to metadata file')
+    parser.add_argument('--metadata_index', default=None, type=str,
+                        help='Path to the metadata index (default: next to the metadata file)')
+    parser.add_argument('--pkl', default='./data/piano_musicxml.pkl', type=str,
+                        help='Pickle file containing list of filtered MusicXML piano files')
+    parser.add_argument('--manifest', default=None, type=str,
+                        help='SQLite manifest recording the status of every file (e.g. ./data/manifest.sqlite)')
+    parser.add_argument('--catalog', default='./data/catalog.sqlite', type=str,
+                        help='SQLite catalog of the files of the pipeline directories')
+    parser.add_argument('--state', default='./data/pipeline_state.json', type=str,
+                        help='JSON file with the fingerprint of the last run of every stage')
+    parser.add_argument('--workers', default=2, type=int,
+                        help='Number of stages running at the same time')
+    parser.add_argument('--force', nargs='*', default=[],
+                        help='Stages to run even if up to date')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only print the stages that would run')
+    parser.add_argument('--converter', default=DEFAULT_COMMAND, type=str,
+                        help='Conversion command, the JSON batch file is given as last argument')
+    parser.add_argument('--convert_workers', default=os.cpu_count(), type=int,
+                        help='Number of converter processes running at the same time')
+    parser.add_argument('--convert_batch_size', default=DEFAULT_BATCH_SIZE, type=int,
+                        help='Number of files per converter batch')
+    parser.add_argument('--convert_timeout', default=DEFAULT_TIMEOUT, type=float,
+                        help='Conversion timeout per file, in seconds '
+                             f'(a batch gets at most {MAX_TIMEOUT_FILES} times this)')
+    parser.add_argument('--note_events', action='store_true',
+                        help='Read pitches from note event arrays instead of music21')
+    parser.add_argument('--threshold', default=0.01, type=float,
+                        help='Similarity score from which a score is a duplicate')
+    parser.add_argument('--difficulties', default='data/200-300_difficulties.pkl', type=str,
+                        help='Pickle file with the difficulties of the scores')
+    parser.add_argument('--dataset_source', default='dataset_musicxml', type=str,
+                        help='Directory containing the MusicXML files of the difficulty file')
+    parser.add_argument('--min_difficulty', default=1, type=int)
+    parser.add_argument('--max_difficulty', default=4, type=int)
+    parser.add_argument('--materialize', default='copy', choices=materialize.MODES,
+                        help='How the dataset files are created (see materialize.py)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Store the intermediate lists as columnar tables (.cols) instead of pickles')
+    parser.add_argument('--split_args', default='', type=str,
+                        help='Arguments of split_musicXML.py for the split and vocab stages, e.g. "-b 8 --binary"')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def file_fingerprint(path):
+    if os.path.isdir(path):  # columnar table
+        h = hashlib.sha1()
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            h.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+        return h.hexdigest()
+    if not os.path.exists(path):
+        return 'missing'
+    stat = os.stat(path)
+    if stat.st_size > HASH_LIMIT:
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+    return file_catalog.content_hash(path)
+
+
+def dir_fingerprint(dir_input, catalog_path):
+    h = hashlib.sha1()
+    if not os.path.isdir(dir_input.path):
+        return 'missing'
+    if not catalog_path:
+        for root, _, files in sorted(os.walk(dir_input.path)):
+            for name in sorted(files):
+                if name.endswith(dir_input.ext):
+                    stat = os.stat(os.path.join(root, name))
+                    h.update(f'{os.path.join(root, name)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+        return h.hexdigest()
+    catalog = file_catalog.open_catalog(catalog_path)
+    try:
+        file_catalog.refresh(catalog, dir_input.path, dir_input.stage)
+        root = os.path.normpath(dir_input.path) + os.sep
+        for path, size, mtime in file_catalog.get_files(catalog, dir_input.stage, dir_input.ext,
+                                                        ('path', 'size', 'mtime_ns')):
+            if path.startswith(root):
+                h.update(f'{path}:{size}:{mtime}\n'.encode('utf-8'))
+    finally:
+        catalog.close()
+    return h.hexdigest()
+
+
+def fingerprint(stage, dep_fingerprints, catalog_path):
+    h = hashlib.sha1()
+    h.update(json.dumps({'stage': stage.name, 'params': stage.params, 'deps': dep_fingerprints},
+                        sort_keys=True, default=str).encode('utf-8'))
+    for item in stage.inputs:
+        if isinstance(item, DirInput):
+            h.update(f'{item}={dir_fingerprint(item, catalog_path)}\n'.encode('utf-8'))
+        else:
+            h.update(f'{item}={file_fingerprint(item)}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def dump(obj, filename):
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as f:
+        pickle.dump(obj, f)
+
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def build_stages(args):
+    dir_path = os.path.expanduser(args.dir_path)
+    piano_path = './data/piano.pkl'
+    pitches_path = './data/pitches.pkl'
+    deduplicated_path = './data/deduplicated.pkl'
+    filtered_difficulties = 'data/difficulties_filtered.pkl'
+    filtered_path = args.pkl
+    if args.columnar:
+        piano_path, pitches_path, deduplicated_path, filtered_difficulties, filtered_path = map(
+            columnar.columnar_path, (piano_path, pitches_path, deduplicated_path, filtered_difficulties, filtered_path))
+    tokens_path = 'data/tokens.pkl'
+    split_args = split_musicXML.parse_args(args.split_args.split() + ['--difficulty', filtered_difficulties])
+
+    def open_manifest():
+        return pipeline_manifest.open_manifest(args.manifest) if args.manifest else None
+
+    def open_catalog():
+        return file_catalog.open_catalog(args.catalog) if args.catalog else None
+
+    def process(params):
+        piano = filter_piano(get_mscz_paths(dir_path, open_catalog()), args.metadata, args.metadata_index)
+        columnar.save_paths(piano_path, piano)
+        manifest = open_manifest()
+        if manifest is not None:
+            pipeline_manifest.add_inputs(manifest, piano)
+
+    def convert(params):
+        catalog = open_catalog()
+        existing = set(get_musicxml_paths(dir_path, catalog)) if catalog is not None else None
+        mscz2musicxml(columnar.load_paths(piano_path), './data/piano.json', params['converter'], args.convert_workers,
+                      args.convert_batch_size, params['timeout'], open_manifest(), existing)
+
+    def filter_scores(params):
+        manifest = open_manifest()
+        if manifest is not None and pipeline_manifest.status_counts(manifest):
+            filtered = filter_with_manifest(manifest, dir_path)
+        else:
+            filtered = [path for path in filter_empty(dir_path, catalog=open_catalog()) if path is not None]
+        columnar.save_paths(filtered_path, filtered)
+
+    def pitch(params):
+        process_pitches(columnar.load_paths(filtered_path), pitches_path, use_events=params['note_events'])
+
+    def similarity(params):
+        paths = process_similarity(pitches_path, params['threshold'])
+        paths = [os.path.join(dir_path, os.path.basename(os.path.dirname(filepath)), os.path.basename(filepath)) for filepath in paths]
+        columnar.save_paths(deduplicated_path, paths)
+
+    def dataset(params):
+        difficulties = load_difficulties(args.difficulties, params['source'],
+                                         params['min_difficulty'], params['max_difficulty'])
+        materialized = create_dataset(params['output'], difficulties, params['materialize'])
+        save_filtered_difficulties(materialized, filtered_difficulties, keep_paths=params['materialize'] == 'manifest')
+
+    def split(params):
+        dump(split_musicXML.tokenize_dataset(split_args), tokens_path)
+
+    def vocab(params):
+        split_musicXML.write_vocab(load(tokens_path), split_args)
+
+    split_params = {key: value for key, value in vars(split_args).items()
+                    if key in ('output', 'dir', 'bars', 'token_fragments')}
+    vocab_params = {key: value for key, value in vars(split_args).items()
+                    if key in ('mapped', 'vocab', 'binary', 'packed', 'shard_size')}
+    scores = DirInput(dir_path, 'scores', '.mscz')
+    musicxml = DirInput(dir_path, 'scores', '.musicxml')
+    return [
+        Stage('process', process, [], [args.metadata, scores], [piano_path], {'dir_path': dir_path}),
+        Stage('convert', convert, ['process'], [piano_path], ['./data/piano.json'],
+              {'converter': args.converter, 'timeout': args.convert_timeout}),
+        Stage('filter', filter_scores, ['convert'], [musicxml], [filtered_path], {}),
+        Stage('pitch', pitch, ['filter'], [filtered_path], [pitches_path], {'note_events': args.note_events}),
+        Stage('similarity', similarity, ['pitch'], [pitches_path], [deduplicated_path],
+              {'threshold': args.threshold}),
+        Stage('dataset', dataset, [], [args.difficulties, DirInput(args.dataset_source, 'dataset_source', '.musicxml')],
+              [filtered_difficulties] + (['dataset_musicxml_filtered'] if args.materialize != 'manifest' else []),
+              {'source': args.dataset_source, 'output': 'dataset_musicxml_filtered', 'materialize': args.materialize,
+               'min_difficulty': args.min_difficulty, 'max_difficulty': args.max_difficulty}),
+        Stage('split', split, ['dataset'], [filtered_difficulties, DirInput(split_args.dir, 'dataset', '.musicxml')],
+              [tokens_path], split_params),
+        Stage('vocab', vocab, ['split'], [tokens_path], [split_args.mapped, split_args.vocab], vocab_params),
+    ]
+
+
+def select_stages(stages, targets):
+    '''
+    The targets and the stages they depend on, in declaration order
+    '''
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [name for name in targets if name not in by_name]
+    if unknown:
+        raise ValueError(f'Unknown stage(s) {unknown}, stages are {list(by_name)}')
+    selected = set()
+    pending = list(targets) or list(by_name)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending += by_name[name].deps
+    return [stage for stage in stages if stage.name in selected]
+
+
+def run_pipeline(stages, state_path, catalog_path, num_workers=2, force=(), dry_run=False):
+    '''
+    Run the stages in dependency order, num_workers at a time, skipping the
+    up-to-date ones. Returns the names of the stages that ran (with dry_run,
+    the stages that would run, nothing is run).
+    '''
+    state = load_state(state_path)
+    lock = threading.Lock()
+    names = {stage.name for stage in stages}
+    done, ran = {}, []  # stage name -> fingerprint
+
+    def run_stage(stage):
+        key = fingerprint(stage, {dep: done[dep] for dep in stage.deps if dep in done}, catalog_path)
+        up_to_date = (state.get(stage.name) == key and stage.name not in force
+                      and all(os.path.exists(output) for output in stage.outputs))
+        if up_to_date:
+            print(f'[{stage.name}] up to date')
+        elif dry_run:
+            print(f'[{stage.name}] would run')
+        else:
+            print(f'[{stage.name}] running')
+            with instrumentation.stage(f'pipeline.{stage.name}'):
+                stage.func(stage.params)
+            with lock:
+                state[stage.name] = key
+                save_state(state, state_path)
+        return key, not up_to_date
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        running = {}
+        remaining = list(stages)
+        while remaining or running:
+            for stage in list(remaining):
+                if all(dep in done or dep not in names for dep in stage.deps):
+                    remaining.remove(stage)
+                    running[executor.submit(run_stage, stage)] = stage
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                done[stage.name], has_run = future.result()
+                if has_run:
+                    ran.append(stage.name)
+    return ran
+
+
+def main():
+    args = parse_args()
+    instrumentation.configure(args.trace, args.profile_rate, args.profile_dir)
+    stages = select_stages(build_stages(args), args.stages)
+    ran = run_pipeline(stages, args.state, args.catalog, args.workers, set(args.force), args.dry_run)
+    print(f"{'Would run' if args.dry_run else 'Ran'} {len(ran)} stage(s): {', '.join(ran) if ran else 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,22 @@
 import os
-import subprocess
 import pandas as pd
 import argparse
 import getch
 import signal
 import json
 from tqdm import tqdm
-import pickle
-import re
 import music21
-import shutil
 import concurrent.futures
-import threading
 from similarity import process_pitches, process_similarity
+from structure_filter import filter_structure
+from convert_pool import DEFAULT_COMMAND, DEFAULT_BATCH_SIZE, DEFAULT_TIMEOUT, MAX_TIMEOUT_FILES, convert_all
+from batch_tokenize import write_failure_manifest
+import manifest as pipeline_manifest
+import metadata_index
+import file_catalog
+import materialize
+import instrumentation
+import columnar
 
 
 def parse_args():
@@ -30,6 +34,10 @@ def parse_args():
                         default='./data/score.jsonl',
                         type=str,
                         help='Path to metadata file')
+    parser.add_argument('--metadata_index',
+                        default=None,
+                        type=str,
+                        help='Path to the metadata index (default: next to the metadata file)')
     parser.add_argument('--csv_path',
                         default='./data/score_annotation.csv',
                         type=str,
@@ -40,6 +48,36 @@ def parse_args():
     parser.add_argument('--convert',
                         action='store_true',
                         help='Convert mscz files to musicxml')
+    parser.add_argument('--converter',
+                        default=DEFAULT_COMMAND,
+                        type=str,
+                        help='Conversion command, the JSON batch file is given as last argument')
+    parser.add_argument('--convert_workers',
+                        default=os.cpu_count(),
+                        type=int,
+                        help='Number of converter processes running at the same time')
+    parser.add_argument('--convert_batch_size',
+                        default=DEFAULT_BATCH_SIZE,
+                        type=int,
+                        help='Number of files per converter process')
+    parser.add_argument('--convert_timeout',
+                        default=DEFAULT_TIMEOUT,
+                        type=float,
+                        help='Conversion timeout per file, in seconds (a batch gets at most '
+                             f'{MAX_TIMEOUT_FILES} times this)')
+    parser.add_argument('--manifest',
+                        default=None,
+                        type=str,
+                        help='SQLite manifest recording the status of every file, interrupted runs resume from it '
+                             '(e.g. ./data/manifest.sqlite)')
+    parser.add_argument('--catalog',
+                        default='./data/catalog.sqlite',
+                        type=str,
+                        help='SQLite catalog of the files of dir_path, refreshed incrementally instead of walking it')
+    parser.add_argument('--scan_workers',
+                        default=file_catalog.DEFAULT_WORKERS,
+                        type=int,
+                        help='Number of threads listing directories for the catalog')
     parser.add_argument('--filter_empty',
                         action='store_true',
                         help='Filter out empty musicxml files')
@@ -49,47 +87,53 @@ def parse_args():
     parser.add_argument('--pitch',
                         action='store_true',
                         help='Compute pitch for every file')
+    parser.add_argument('--note_events',
+                        action='store_true',
+                        help='Compute pitches from note event arrays instead of music21')
     parser.add_argument('--similarity',
                         action='store_true',
                         help='Filter out similar files')
+    parser.add_argument('--materialize',
+                        default='copy',
+                        choices=materialize.MODES,
+                        help='How the dataset files are created: copy, hardlink, reflink, auto (reflink, '
+                             'else hardlink, else copy) or manifest (no file, the original paths are used)')
+    parser.add_argument('--columnar',
+                        action='store_true',
+                        help='Store the intermediate lists (piano, filtered files, pitches, difficulties) '
+                             'as columnar tables (.cols) instead of pickles')
+    instrumentation.add_arguments(parser)
     return parser.parse_args()
 
 
-def filter_piano(filenames, metadata):
+def filter_piano(filenames, metadata, index_path=None):
     '''
-    Function to filter out files that are not piano (looking at the MuseScore metadata)
+    Function to filter out files that are not piano (looking at the MuseScore metadata index)
     '''
-    lookup = {}
-
-    with open(metadata) as f:
-        # Parse each line in the file
-        for line in tqdm(f):
-            # Parse the JSON in the line
-            data = json.loads(line)
-            # Add the JSON object to the lookup table using the authorUserId as the key
-            try:
-                lookup[data["id"]] = data
-            except KeyError:
-                pass
+    index = metadata_index.build_index(metadata, index_path)
+    records = metadata_index.lookup(index, [metadata_index.file_id(f) for f in filenames])
+    index.close()
 
     piano = []
-    # Iterate over the filenames
     for filename in tqdm(filenames):
-        # Extract the ID from the filename
-        file_id = os.path.splitext(os.path.basename(filename))[0]
-        # Look up the corresponding JSON object in the lookup table using the ID as the key
-        if file_id in lookup:
-            # Check if the instrumentsNames field contains "Piano"
-            if lookup[file_id]["instrumentsNames"] == ['Piano'] or lookup[file_id]["instrumentsNames"] == ['piano']:
-                piano.append(filename)
+        record = records.get(metadata_index.file_id(filename))
+        if record is not None and metadata_index.is_piano_record(record):
+            piano.append(filename)
     print(f'Got {len(piano)} piano scores')
     return piano
 
 
-def get_mscz_paths(dir_path):
+def get_mscz_paths(dir_path, catalog=None, num_workers=file_catalog.DEFAULT_WORKERS):
     '''
     Get list of .mscz files
     '''
+    if catalog is not None:
+        file_catalog.refresh(catalog, dir_path, 'scores', num_workers)
+        root = os.path.normpath(dir_path)
+        # only the files of the subdirectories, as below
+        return [path for path in file_catalog.get_files(catalog, 'scores', '.mscz')
+                if os.path.dirname(os.path.dirname(path)) == root]
+
     # Get list of all subdirectories in directory
     subdir_list = [f.path for f in os.scandir(dir_path) if f.is_dir()]
 
@@ -102,68 +146,57 @@ def get_mscz_paths(dir_path):
     return file_list
 
 
-def mscz2musicxml(scores, json_name):
+def mscz2musicxml(scores, json_name, command=DEFAULT_COMMAND, num_workers=os.cpu_count(),
+                  batch_size=DEFAULT_BATCH_SIZE, timeout=DEFAULT_TIMEOUT, manifest=None, existing=None):
     '''
-    Convert all MuseScore files into MusicXML files in the same folders
-    Handles corrupt files and errors with mscore process.
-    TODO: Catch subprocess freezing
+    Convert all MuseScore files into MusicXML files in the same folders.
+    Small batches run in parallel with a timeout, the files that crash or hang
+    the converter are isolated by bisection and listed next to json_name.
+    With a manifest connection, only the pending files are converted and
+    the status of every file is recorded as soon as its batch is done.
+    existing is the set of MusicXML files already written (from the catalog),
+    otherwise every output is checked on disk.
     '''
-    to_discard = []
-    pattern = r"\/\w+(?:\/\w+)*\/\d+\.\w+"
-    json_batch = create_convert_batch(scores, to_discard)
+    callback = None
+    if manifest is not None:
+        pipeline_manifest.add_inputs(manifest, scores)
+        resumed = pipeline_manifest.sync_converted(manifest, existing)
+        if resumed:
+            print(f"{resumed} file(s) already converted")
+        pending = pipeline_manifest.get_files(manifest, pipeline_manifest.PENDING)
+        json_batch = [{'in': path, 'out': pipeline_manifest.musicxml_path(path)} for path in pending]
+        print(f"Job will process {len(json_batch)} files")
+
+        def callback(converted, failures):
+            pipeline_manifest.set_status(manifest, [item['in'] for item in converted],
+                                         pipeline_manifest.CONVERTED)
+            pipeline_manifest.set_status(manifest, [f['path'] for f in failures], pipeline_manifest.FAILED,
+                                         [f"convert: {f['reason']}" for f in failures])
+    else:
+        json_batch = create_convert_batch(scores, [], existing)
     with open(json_name, 'w') as f:
         json.dump(json_batch, f)
-    while True:
-        mscore_process = subprocess.Popen(
-            ['musescore.mscore', '-j', json_name], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        print('Waiting to finish')
-
-        # Print live output of the subprocess
-        while True:
-            output = mscore_process.stdout.readline()
-            if output == b'' and mscore_process.poll() is not None:
-                break
-            last_line = output
-            if output:
-                output = output.decode("utf-8").strip()
-                print(output)  # Subprocess output
-                match = re.search(pattern, output)
-                if match:
-                    problematic_file = match.group(0)
-
-        if mscore_process.returncode != 0:
-            print('Job stopped unexpectedly\n')
-            if problematic_file not in to_discard:
-                # Add file that's problematic to the discard list
-                print(f"Discarding {problematic_file}")
-                to_discard.append(problematic_file)
-
-        print(f"There are {len(to_discard)} discarded file(s)")
-
-        json_batch = create_convert_batch(scores, to_discard)
-        if len(json_batch) == 0:
-            break
-        with open(json_name, 'w') as f:
-            json.dump(json_batch, f)
+
+    with instrumentation.stage('mscz2musicxml', len(json_batch)):
+        converted, failures = convert_all(json_batch, command, num_workers, batch_size, timeout, callback)
+    write_failure_manifest(failures, os.path.splitext(json_name)[0] + '_failures.jsonl')
+    print(f"Converted {len(converted)} file(s), {len(failures)} discarded file(s)")
     print('Done')
 
 
-def create_convert_batch(score_list, to_discard):
+def create_convert_batch(score_list, to_discard, existing=None):
     '''
     Create JSON batch file for the conversion with mscore
     '''
     json_out = []
 
-    for d in to_discard:
-        filename = d.split('/')[-1]
-        for i, item in enumerate(score_list):
-            if filename == item.split('/')[-1]:
-                score_list.pop(i)
-                break
+    discarded = {d.split('/')[-1] for d in to_discard}
+    score_list[:] = [item for item in score_list if item.split('/')[-1] not in discarded]
 
     for filename in tqdm(score_list):
         musicxml_name = filename.replace('.mscz', '.musicxml')
-        if os.path.exists(musicxml_name):
+        exists = musicxml_name in existing if existing is not None else os.path.exists(musicxml_name)
+        if exists:
             continue
         output = {}
         output['in'] = filename
@@ -173,10 +206,19 @@ def create_convert_batch(score_list, to_discard):
     return json_out
 
 
-def get_musicxml_paths(data_path):
+def get_musicxml_paths(data_path, catalog=None, num_workers=file_catalog.DEFAULT_WORKERS):
     '''
     Get list of .musicxml files
     '''
+    if catalog is not None:
+        file_catalog.refresh(catalog, data_path, 'scores', num_workers)
+        root = os.path.normpath(data_path) + os.sep
+        # the catalog holds the files of every root scanned, keep the ones under data_path as os.walk does
+        musicxml_files = [path for path in file_catalog.get_files(catalog, 'scores', '.musicxml')
+                          if path.startswith(root)]
+        print(f'Total number of musicxml files: {len(musicxml_files)}')
+        return musicxml_files
+
     count = 0
     musicxml_files = []
     for root, _, files in os.walk(data_path):
@@ -207,103 +249,138 @@ def is_piano(musicxml):
     return musicxml
 
 
-def filter_empty(data_path, num_threads=os.cpu_count()):
+def filter_empty(data_path, num_workers=os.cpu_count(), paths=None, catalog=None):
+    '''
+    Filter out files that either have empty staves or don't have exactly 2 staves (left/right hand).
+    Same criterion as is_piano, checked with a streaming XML scan across a process pool.
+    '''
+    musicxml_paths = get_musicxml_paths(data_path, catalog) if paths is None else paths
+    with instrumentation.stage('filter_empty', len(musicxml_paths)):
+        return filter_structure(musicxml_paths, num_workers)
+
+
+def filter_with_manifest(manifest, data_path, chunk_size=1000):
     '''
-    Filter out files that either have empty staves or don't have exactly 2 staves (left/right hand)
+    Filter the converted files that were not filtered yet, recording the
+    result of every chunk in the manifest. Returns the kept MusicXML paths.
     '''
-    musicxml_paths = get_musicxml_paths(data_path)
-    results = []
-    threads = []
-
-    for file in tqdm(musicxml_paths):
-        thread = threading.Thread(target=results.append(is_piano(file)))
-        threads.append(thread)
-
-        if len(threads) >= num_threads:
-            for t in threads:
-                t.start()
-            for t in threads:
-                t.join()
-            threads = []
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-    return results
-
-
-def create_filtered_pickle(filename, data_path):
+    # outputs converted without the manifest (or by an interrupted run) are still pending
+    resumed = pipeline_manifest.sync_converted(manifest)
+    if resumed:
+        print(f"{resumed} converted file(s) found on disk")
+    to_check = pipeline_manifest.get_files(manifest, pipeline_manifest.CONVERTED, 'musicxml')
+    print(f"{len(to_check)} file(s) to filter")
+    for i in range(0, len(to_check), chunk_size):
+        chunk = to_check[i:i + chunk_size]
+        results = filter_empty(data_path, paths=chunk)
+        kept = [path for path, result in zip(chunk, results) if result is not None]
+        rejected = [path for path, result in zip(chunk, results) if result is None]
+        pipeline_manifest.set_status(manifest, kept, pipeline_manifest.FILTERED, by='musicxml')
+        pipeline_manifest.set_status(manifest, rejected, pipeline_manifest.FAILED,
+                                     'filter_empty: not a two-staff piano score', by='musicxml')
+    return pipeline_manifest.get_files(
+        manifest, (pipeline_manifest.FILTERED, pipeline_manifest.TOKENIZED), 'musicxml')
+
+
+def create_filtered_pickle(filename, data_path, manifest=None, catalog=None):
     '''
     Create pickle file containing the list of filtered piano paths
+    (from the manifest when it holds the converted files)
     '''
     filtered_musicxml = None
-    if not os.path.exists(filename):
-        filtered_musicxml = filter_empty(data_path)
-        with open(filename, 'wb') as f:
-            pickle.dump(filtered_musicxml, f)
+    if manifest is not None and pipeline_manifest.status_counts(manifest):
+        filtered_musicxml = filter_with_manifest(manifest, data_path)
+        columnar.save_paths(filename, filtered_musicxml)
+    elif not os.path.exists(filename):
+        filtered_musicxml = [path for path in filter_empty(data_path, catalog=catalog) if path is not None]
+        columnar.save_paths(filename, filtered_musicxml)
     else:
-        with open(filename, 'rb') as f:
-            filtered_musicxml = pickle.load(f)
+        filtered_musicxml = columnar.load_paths(filename)
     return filtered_musicxml
 
 
-def create_dataset(dataset_filtered, difficulties):
-    os.makedirs(dataset_filtered, exist_ok=True)
+def create_dataset(dataset_filtered, difficulties, mode='copy', num_workers=os.cpu_count()):
+    '''
+    Materialize the selected files in dataset_filtered (see materialize.py for the modes),
+    returns the (path to read, difficulty) list
+    '''
+    paths, counts = materialize.materialize([path for path, _ in difficulties], dataset_filtered,
+                                            mode, num_workers)
+    print(f'Dataset materialized: {counts}')
+    return [(path, difficulty) for path, (_, difficulty) in zip(paths, difficulties)]
 
-    for filepath, _ in tqdm(difficulties, 'Copying dataset'):
-        shutil.copy(filepath, dataset_filtered)
+def load_difficulties(filename, dataset_dir='dataset_musicxml', min_difficulty=1, max_difficulty=4):
+    '''
+    (path in dataset_dir, rounded ensemble difficulty) of the scores between min and max difficulty
+    '''
+    difficulties = columnar.load_rows(filename)
+    difficulties = [(os.path.join(dataset_dir, os.path.basename(path)), round(diff_ensemble)) for path, diff_ensemble, diff_p, diff_argnn, diff_virtuoso in difficulties]
 
-def save_filtered_difficulties(filtered_difficulties):
-    filtered_difficulties = [(os.path.basename(path), difficulty) for path, difficulty in filtered_difficulties]
-    with open('data/difficulties_filtered.pkl', 'wb') as f:
-        pickle.dump(filtered_difficulties, f)
+    return [(path, difficulty) for path, difficulty in difficulties if min_difficulty <= difficulty <= max_difficulty]
+
+def save_filtered_difficulties(filtered_difficulties, filename='data/difficulties_filtered.pkl', keep_paths=False):
+    '''
+    keep_paths: store the paths as given (manifest-only dataset) instead of the file names
+    '''
+    if not keep_paths:
+        filtered_difficulties = [(os.path.basename(path), difficulty) for path, difficulty in filtered_difficulties]
+    columnar.save_rows(filename, filtered_difficulties)
 
 def main():
     args = parse_args()
+    instrumentation.configure(args.trace, args.profile_rate, args.profile_dir)
     piano = None
     piano_path = './data/piano.pkl'
+    pitches_path = './data/pitches.pkl'
+    filtered_difficulties_path = 'data/difficulties_filtered.pkl'
+    if args.columnar:
+        piano_path, pitches_path, args.pkl, filtered_difficulties_path = map(
+            columnar.columnar_path, (piano_path, pitches_path, args.pkl, filtered_difficulties_path))
     dir_path = os.path.expanduser(args.dir_path)
+    manifest = pipeline_manifest.open_manifest(args.manifest) if args.manifest else None
+    catalog = file_catalog.open_catalog(args.catalog) if args.catalog else None
     if args.process:
-        file_list = get_mscz_paths(dir_path)
+        file_list = get_mscz_paths(dir_path, catalog, args.scan_workers)
         piano = filter_piano(
-            file_list, args.metadata)
-        with open(piano_path, 'wb') as f:
-            pickle.dump(piano, f)
+            file_list, args.metadata, args.metadata_index)
+        columnar.save_paths(piano_path, piano)
+        if manifest is not None:
+            pipeline_manifest.add_inputs(manifest, piano)
 
     if args.convert:
-        if not args.process:
+        if not args.process and manifest is not None and pipeline_manifest.status_counts(manifest):
+            piano = pipeline_manifest.get_files(manifest)
+        elif not args.process:
             if not os.path.exists(piano_path):
                 raise Exception('Pickle file does not exist')
-            with open(piano_path, 'rb') as f:
-                piano = pickle.load(f)
-        mscz2musicxml(piano, './data/piano.json')
+            piano = columnar.load_paths(piano_path)
+        existing = set(get_musicxml_paths(dir_path, catalog, args.scan_workers)) if catalog is not None else None
+        mscz2musicxml(piano, './data/piano.json', args.converter, args.convert_workers,
+                      args.convert_batch_size, args.convert_timeout, manifest, existing)
+        if manifest is not None:
+            print(pipeline_manifest.status_counts(manifest))
 
     if args.pitch:
         if args.filter_empty:
-            piano_musicxml = create_filtered_pickle(args.pkl, dir_path)
+            piano_musicxml = create_filtered_pickle(args.pkl, dir_path, manifest, catalog)
             print(f"There are {len(piano_musicxml)} piano files")
         else:
             if args.musicxml_data:
-                piano_musicxml = get_musicxml_paths(dir_path)
+                piano_musicxml = get_musicxml_paths(dir_path, catalog, args.scan_workers)
             else:
-                with open(args.pkl, 'rb') as f:
-                    piano_musicxml = pickle.load(f)
+                piano_musicxml = columnar.load_paths(args.pkl)
 
-        process_pitches(piano_musicxml, './data/pitches.pkl')
+        process_pitches(piano_musicxml, pitches_path, use_events=args.note_events)
 
     if args.similarity:
-        paths = process_similarity()
+        paths = process_similarity(pitches_path)
         paths = [os.path.join(dir_path, os.path.basename(os.path.dirname(filepath)), os.path.basename(filepath)) for filepath in paths]
 
-    with open('data/200-300_difficulties.pkl', 'rb') as f:
-        difficulties = pickle.load(f)
-        difficulties = [(os.path.join('dataset_musicxml', os.path.basename(path)), round(diff_ensemble)) for path, diff_ensemble, diff_p, diff_argnn, diff_virtuoso in difficulties]
-
-    filtered_difficulties = [(path, difficulty) for path, difficulty in difficulties if 1 <= difficulty <= 4]
+    filtered_difficulties = load_difficulties('data/200-300_difficulties.pkl')
 
-    create_dataset('dataset_musicxml_filtered', filtered_difficulties)
+    materialized = create_dataset('dataset_musicxml_filtered', filtered_difficulties, args.materialize)
 
-    save_filtered_difficulties(filtered_difficulties)
+    save_filtered_difficulties(materialized, filtered_difficulties_path, keep_paths=args.materialize == 'manifest')
 
 
 if __name__ == "__main__":
@@ -4,44 +4,32 @@ import pandas as pd
 import argparse
 import getch
 import signal
-import json
 from tqdm import tqdm
 import pickle
 import re
 import music21
 import shutil
 from process_musescore import parse_args, get_mscz_paths
+import metadata_index
 
 
-def filter_piano(filenames, metadata):
-    lookup = {}
-
-    with open(metadata) as f:
-        # Parse each line in the file
-        for line in tqdm(f):
-            # Parse the JSON in the line
-            data = json.loads(line)
-            # Add the JSON object to the lookup table using the authorUserId as the key
-            try:
-                lookup[data["id"]] = data
-            except KeyError:
-                pass
+def filter_piano(filenames, metadata, index_path=None):
+    index = metadata_index.build_index(metadata, index_path)
+    records = metadata_index.lookup(index, [metadata_index.file_id(f) for f in filenames])
+    index.close()
 
     piano = 0
     not_piano = 0
     # Iterate over the filenames
     for filename in tqdm(filenames):
-        # Extract the ID from the filename
-        file_id = os.path.splitext(os.path.basename(filename))[0]
-        # Look up the corresponding JSON object in the lookup table using the ID as the key
-        if file_id in lookup:
-            # Check if the instrumentsNames field contains "Piano"
-            if lookup[file_id]["instrumentsNames"] == ['Piano'] or lookup[file_id]["instrumentsNames"] == ['piano']:
-                piano += 1
-            else:
-                if os.path.exists(filename):
-                    os.remove(filename)
-                    not_piano += 1
+        record = records.get(metadata_index.file_id(filename))
+        if record is None:
+            continue
+        if metadata_index.is_piano_record(record):
+            piano += 1
+        elif os.path.exists(filename):
+            os.remove(filename)
+            not_piano += 1
 
     print(f'Got {piano} piano scores')
     print(f'Removed {not_piano} scores')
@@ -60,7 +48,7 @@ def main():
     args = parse_args()
     path = os.path.expanduser(args.dir_path)
     #file_list = get_mscz_paths(path)
-    #filter_piano(file_list, args.metadata)
+    #filter_piano(file_list, args.metadata, args.metadata_index)
     remove_all_mscz(path)
 
 
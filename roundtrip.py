@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+import tempfile
+import concurrent.futures
+from functools import partial
+import numpy as np
+from tqdm import tqdm
+from score_to_tokens import MusicXML_to_tokens
+from score_to_tokens_stream import MusicXML_to_tokens_stream
+from tokens_to_score import tokens_to_score
+from tokens_to_musicxml import write_musicxml
+
+"""
+Round-trip fidelity and throughput harness
+
+Every MusicXML file of a directory is tokenized, decoded back to MusicXML
+and tokenized again, across a process pool. The report holds, per file,
+whether both token sequences are identical and the first differences, and
+for the whole corpus the mismatches per category (token kind and edit
+operation), the fidelity and the throughput and latency percentiles of
+each direction.
+
+python roundtrip.py --dir DIR --save_baseline baseline.json
+python roundtrip.py --dir DIR --baseline baseline.json
+
+With --baseline, the exit status is 1 when the fidelity or the throughput
+of a direction falls below the baseline (minus the tolerances).
+
+Both tokenizers order the voices of a measure by set iteration, which
+depends on the hash seed: unless PYTHONHASHSEED is set, the harness runs
+itself again with PYTHONHASHSEED=HASH_SEED (inherited by the workers), so
+that the fidelity of two runs can be compared.
+"""
+
+HASH_SEED = '0'
+
+tokenizers = {
+    'stream': MusicXML_to_tokens_stream,
+    'bs4': MusicXML_to_tokens,
+}
+
+detokenizers = {
+    'music21': lambda string, path: tokens_to_score(string).write('musicxml', path),
+    'direct': write_musicxml,
+}
+
+directions = ('tokenize', 'detokenize', 'retokenize')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Round-trip MusicXML -> tokens -> MusicXML -> tokens')
+    parser.add_argument('--dir', type=str, required=True,
+                        help='Directory of MusicXML files')
+    parser.add_argument('--tokenizer', type=str, default='stream', choices=list(tokenizers))
+    parser.add_argument('--detokenizer', type=str, default='music21', choices=list(detokenizers))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunksize', type=int, default=4)
+    parser.add_argument('--max_diffs', type=int, default=10,
+                        help='Number of differences kept per file in the report')
+    parser.add_argument('--output', type=str, default='roundtrip_report.json',
+                        help='JSON report')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Report of a previous run to check this run against')
+    parser.add_argument('--save_baseline', type=str, default=None,
+                        help='Write the summary of this run as a baseline')
+    parser.add_argument('--fidelity_tolerance', type=float, default=0.0,
+                        help='Allowed drop of the fidelity (fraction of identical files) from the baseline')
+    parser.add_argument('--throughput_tolerance', type=float, default=0.2,
+                        help='Allowed relative drop of the throughput of each direction from the baseline')
+    return parser.parse_args()
+
+
+def token_kind(token):
+    return token.split('_')[0] if token else 'none'
+
+
+def diff_tokens(tokens, retokens, max_diffs=10):
+    '''
+    Differences between two token sequences: number of matching tokens,
+    mismatch counts per category (operation:token kind) and the first differences
+    '''
+    matcher = difflib.SequenceMatcher(None, tokens, retokens, autojunk=False)
+    categories, diffs, matching = {}, [], 0
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            matching += i2 - i1
+            continue
+        for t in tokens[i1:i2] or retokens[j1:j2]:
+            category = f'{op}:{token_kind(t)}'
+            categories[category] = categories.get(category, 0) + 1
+        if len(diffs) < max_diffs:
+            diffs.append({'op': op, 'position': i1,
+                          'original': tokens[i1:i2], 'roundtrip': retokens[j1:j2]})
+    return matching, categories, diffs
+
+
+def roundtrip_file(path, tmp_dir, tokenizer='stream', detokenizer='music21', max_diffs=10):
+    result = {'path': path}
+    xml_path = os.path.join(tmp_dir, f'{os.getpid()}_{os.path.basename(path)}')
+    try:
+        start = time.perf_counter()
+        tokens = [t for t in tokenizers[tokenizer](path) if t is not None]
+        result['tokenize'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        detokenizers[detokenizer](' '.join(tokens), xml_path)
+        result['detokenize'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        retokens = [t for t in tokenizers[tokenizer](xml_path) if t is not None]
+        result['retokenize'] = time.perf_counter() - start
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        return result
+    finally:
+        if os.path.exists(xml_path):
+            os.remove(xml_path)
+
+    matching, categories, diffs = diff_tokens(tokens, retokens, max_diffs)
+    result.update({
+        'tokens': len(tokens),
+        'retokens': len(retokens),
+        'matching': matching,
+        'identical': tokens == retokens,
+        'categories': categories,
+        'diffs': diffs,
+    })
+    return result
+
+
+def run_roundtrip(paths, tokenizer='stream', detokenizer='music21', num_workers=os.cpu_count(),
+                  chunksize=4, max_diffs=10):
+    '''
+    Round-trip every path across num_workers processes, results keep the input order
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        worker = partial(roundtrip_file, tmp_dir=tmp_dir, tokenizer=tokenizer,
+                         detokenizer=detokenizer, max_diffs=max_diffs)
+        start = time.perf_counter()
+        if num_workers is None or num_workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = list(tqdm(executor.map(worker, paths, chunksize=chunksize),
+                                    'Round trip', total=len(paths)))
+        else:
+            results = [worker(p) for p in tqdm(paths, 'Round trip')]
+        wall_time = time.perf_counter() - start
+    return results, wall_time
+
+
+def summarize(results, wall_time):
+    done = [r for r in results if 'error' not in r]
+    summary = {
+        'files': len(results),
+        'errors': len(results) - len(done),
+        'identical': sum(r['identical'] for r in done),
+        'fidelity': sum(r['identical'] for r in done) / len(results) if results else 0.0,
+        'token_fidelity': (sum(r['matching'] for r in done) / max(sum(r['tokens'] for r in done), 1)),
+        'wall_seconds': wall_time,
+        'files_per_s': len(results) / wall_time if wall_time else None,
+        'categories': {},
+        'directions': {},
+    }
+    for r in done:
+        for category, count in r['categories'].items():
+            summary['categories'][category] = summary['categories'].get(category, 0) + count
+    summary['categories'] = dict(sorted(summary['categories'].items(), key=lambda c: -c[1]))
+
+    n_tokens = sum(r['tokens'] for r in done)
+    for direction in directions:
+        latencies = np.array([r[direction] for r in done])
+        if not len(latencies):
+            continue
+        summary['directions'][direction] = {
+            'tokens_per_s': n_tokens / latencies.sum() if latencies.sum() else None,
+            'files_per_s': len(latencies) / latencies.sum() if latencies.sum() else None,
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+        }
+    return summary
+
+
+def check_baseline(summary, baseline, fidelity_tolerance=0.0, throughput_tolerance=0.2):
+    '''
+    List of the regressions of summary compared to the baseline summary
+    '''
+    regressions = []
+    for key in ('fidelity', 'token_fidelity'):
+        if summary[key] < baseline[key] - fidelity_tolerance:
+            regressions.append(f'{key} {summary[key]:.4f} < baseline {baseline[key]:.4f}')
+    for direction, old in baseline.get('directions', {}).items():
+        new = summary['directions'].get(direction)
+        if new is None or not old.get('tokens_per_s'):
+            continue
+        if new['tokens_per_s'] < old['tokens_per_s'] * (1 - throughput_tolerance):
+            regressions.append(f"{direction} {new['tokens_per_s']:.0f} tokens/s < baseline "
+                               f"{old['tokens_per_s']:.0f} tokens/s")
+    return regressions
+
+
+def print_summary(summary):
+    print(f"{summary['identical']}/{summary['files']} files identical after the round trip "
+          f"({summary['errors']} errors), token fidelity {summary['token_fidelity']:.4f}")
+    for category, count in list(summary['categories'].items())[:10]:
+        print(f'  {category:20s} {count}')
+    for direction, d in summary['directions'].items():
+        print(f"{direction:10s} {d['tokens_per_s']:10.0f} tokens/s  "
+              f"p50 {d['p50'] * 1000:.1f} ms  p90 {d['p90'] * 1000:.1f} ms  p99 {d['p99'] * 1000:.1f} ms")
+
+
+def pin_hash_seed():
+    if os.environ.get('PYTHONHASHSEED', 'random') == 'random':
+        os.environ['PYTHONHASHSEED'] = HASH_SEED
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def main():
+    pin_hash_seed()
+    args = parse_args()
+    paths = sorted(os.path.join(args.dir, f) for f in os.listdir(args.dir)
+                   if f.endswith('.musicxml') or f.endswith('.xml'))
+
+    results, wall_time = run_roundtrip(paths, args.tokenizer, args.detokenizer, args.workers,
+                                       args.chunksize, args.max_diffs)
+    summary = summarize(results, wall_time)
+    summary.update({'tokenizer': args.tokenizer, 'detokenizer': args.detokenizer})
+    print_summary(summary)
+
+    with open(args.output, 'w') as f:
+        json.dump({'summary': summary, 'files': results}, f, indent=2)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baseline = baseline.get('summary', baseline)
+        regressions = check_baseline(summary, baseline, args.fidelity_tolerance,
+                                     args.throughput_tolerance)
+        for r in regressions:
+            print(f'REGRESSION {r}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,10 @@ from bs4 import BeautifulSoup
 from bs4.element import Tag
 from fractions import Fraction
 import pretty_midi
+from score_to_tokens_stream import prepare_records, records_to_tokens, split_staves
+
+# bump when a change to the tokenizers changes their output (invalidates token caches)
+TOKENIZER_VERSION = 1
 
 
 # tokenize 'attributes' section in MusicXML
@@ -255,6 +259,77 @@ def measures_to_tokens(measures, soup, staff=None, note_name=True):
     return tokens
 
 
+# read a 'note', 'attributes', ... tag into a record without modifying the soup
+def tag_to_record(element):
+    record = {
+        'name': element.name,
+        'staff': int(element.staff.text) if element.staff else None,
+        'voice': element.voice.text if element.voice else None,
+    }
+
+    if element.name == 'note':
+        record.update({
+            'duration': int(element.duration.text) if element.duration else None,  # None for gracenotes
+            'chord': element.chord is not None,
+            'rest': element.rest is not None,
+            'pitches': [(p.step.text, p.alter.text if p.alter else None, p.octave.text)
+                        for p in element.find_all('pitch')],
+            'stem': element.stem.text if element.stem else None,
+            'beams': [b.text for b in element.find_all('beam')],
+            'tie': element.tied.attrs['type'] if element.tied else None,
+            'merged': False,
+        })
+    elif element.name in ('backup', 'forward'):
+        record['duration'] = int(element.duration.text)
+    elif element.name == 'attributes':
+        divisions = None
+        attributes = []
+        for child in element.contents:
+            if not isinstance(child, Tag):
+                continue
+            if child.name == 'divisions':
+                divisions = int(child.text)
+            elif child.name in ('clef', 'key', 'time'):
+                number = int(child['number']) if 'number' in child.attrs else None
+                attributes.append((number, attribute_to_token(child)))
+        record['divisions'] = divisions
+        record['attributes'] = attributes
+
+    return record
+
+
+def measure_to_records(measure, staff_mode):
+    records = [tag_to_record(e) for e in measure.contents if isinstance(e, Tag)]
+    return prepare_records(records, staff_mode)
+
+
+# tokenize both staves of a single-part score in one traversal per measure
+def measures_to_tokens_single_pass(measures, note_name=True):
+    R_tokens, L_tokens = [], []
+    R_divisions, L_divisions = 0, 0
+    for measure in measures:
+        buckets = split_staves(measure_to_records(measure, staff_mode=True))
+        tokens, R_divisions = records_to_tokens(
+            buckets[1], R_divisions, staff=1, note_name=note_name)
+        R_tokens += tokens
+        tokens, L_divisions = records_to_tokens(
+            buckets[2], L_divisions, staff=2, note_name=note_name)
+        L_tokens += tokens
+
+    return R_tokens, L_tokens
+
+
+def part_to_tokens_single_pass(measures, note_name=True):
+    tokens = []
+    divisions = 0
+    for measure in measures:
+        measure_tokens, divisions = records_to_tokens(
+            measure_to_records(measure, staff_mode=False), divisions, note_name=note_name)
+        tokens += measure_tokens
+
+    return tokens
+
+
 def load_MusicXML(mxml_path):  # load MusicXML contents using BeautifulSoup
     soup = BeautifulSoup(open(mxml_path, encoding='utf-8'),
                          'lxml-xml', from_encoding='utf-8')  # MusicXML
@@ -266,9 +341,16 @@ def load_MusicXML(mxml_path):  # load MusicXML contents using BeautifulSoup
     return [part.find_all('measure') for part in parts], soup
 
 
-def MusicXML_to_tokens(soup_or_mxml_path, note_name=True):  # use this method
+def MusicXML_to_tokens(soup_or_mxml_path, note_name=True, single_pass=False):  # use this method
+    '''
+    With single_pass=True, each measure is read once for both staves and the
+    soup is left untouched, so a cached soup can be tokenized several times.
+    '''
     if type(soup_or_mxml_path) is str:
         parts, soup = load_MusicXML(soup_or_mxml_path)
+    elif single_pass:
+        soup = soup_or_mxml_path
+        parts = [part.find_all('measure') for part in soup.find_all('part')]
     else:
         soup = soup_or_mxml_path
         for tag in soup(string='\n'):  # eliminate line breaks
@@ -276,6 +358,15 @@ def MusicXML_to_tokens(soup_or_mxml_path, note_name=True):  # use this method
 
         parts = [part.find_all('measure') for part in soup.find_all('part')]
 
+    if single_pass:
+        if len(parts) == 1:
+            R_tokens, L_tokens = measures_to_tokens_single_pass(
+                parts[0], note_name=note_name)
+        elif len(parts) == 2:
+            R_tokens = part_to_tokens_single_pass(parts[0], note_name=note_name)
+            L_tokens = part_to_tokens_single_pass(parts[1], note_name=note_name)
+        return ['R'] + R_tokens + ['L'] + L_tokens
+
     if len(parts) == 1:
         tokens = ['R'] + \
             measures_to_tokens(parts[0], soup, staff=1, note_name=note_name)
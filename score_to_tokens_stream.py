@@ -0,0 +1,494 @@
+"""
+Streaming tokenizer engine based on lxml.etree.iterparse
+
+Produces the same tokens as score_to_tokens.MusicXML_to_tokens, but walks the
+<part>/<measure> elements in a single pass and frees every measure as soon as
+it has been tokenized, so memory stays flat on long scores.
+
+Every measure is first reduced to a list of element records (plain dicts),
+then tokenized for each staff from those records.
+"""
+
+from fractions import Fraction
+from lxml import etree
+import numpy as np
+import pretty_midi
+
+beam_translations = {'begin': 'start', 'end': 'stop',
+                     'forward hook': 'partial-right', 'backward hook': 'partial-left'}
+alter_to_symbol = {'-2': 'bb', '-1': 'b', '0': '', '1': '#', '2': '##'}
+step_to_semitone = {'C': 0, 'D': 2, 'E': 4,
+                    'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+# one row per sounding pitch, onset and duration in quarter lengths
+note_event_dtype = np.dtype([('onset', np.float64), ('duration', np.float32),
+                             ('pitch', np.int16), ('staff', np.int8), ('voice', np.int8),
+                             ('chord', np.int32), ('measure', np.int32), ('flags', np.uint8)])
+
+# note event flags
+TIE_START = 1
+TIE_STOP = 2
+STEM_UP = 4
+STEM_DOWN = 8
+BEAM = 16
+GRACE = 32
+
+
+def find_text(element, name):
+    child = element.find('.//' + name)
+    return None if child is None else (child.text or '')
+
+
+def attribute_to_token(child):  # clef, key signature, and time signature
+    type_ = child.tag
+    if type_ == 'clef':
+        sign = find_text(child, 'sign')
+        if sign == 'G':
+            return 'clef_treble'
+        elif sign == 'F':
+            return 'clef_bass'
+    elif type_ == 'key':
+        key = int(child.find('.//fifths').text)
+        if key < 0:
+            return f'key_flat_{abs(key)}'
+        elif key > 0:
+            return f'key_sharp_{key}'
+        else:
+            return f'key_natural_{key}'
+    elif type_ == 'time':
+        times = [int(c.text) for c in child if isinstance(c.tag, str)]
+        if times[1] == 2:
+            return f'time_{times[0]*2}/{times[1]*2}'
+        elif times[1] > 4:
+            fraction = str(Fraction(times[0], times[1]))
+            if int(fraction.split('/')[1]) == 2:  # X/2
+                return f"time_{int(fraction.split('/')[0])*2}/{int(fraction.split('/')[0])*2}"
+            else:
+                return 'time_' + fraction
+        else:
+            return f'time_{times[0]}/{times[1]}'
+
+
+def element_to_record(element):
+    '''
+    Reduce a child of <measure> to the fields needed for tokenization
+    '''
+    name = element.tag
+    staff = find_text(element, 'staff')
+    record = {
+        'name': name,
+        'staff': int(staff) if staff is not None else None,
+        'voice': find_text(element, 'voice'),
+    }
+
+    if name == 'note':
+        duration = find_text(element, 'duration')
+        tied = element.find('.//tied')
+        record.update({
+            'duration': int(duration) if duration is not None else None,  # None for gracenotes
+            'chord': element.find('.//chord') is not None,
+            'rest': element.find('.//rest') is not None,
+            'pitches': [(find_text(p, 'step'), find_text(p, 'alter'), find_text(p, 'octave'))
+                        for p in element.iter('pitch')],
+            'stem': find_text(element, 'stem'),
+            'beams': [b.text or '' for b in element.iter('beam')],
+            'tie': tied.attrib['type'] if tied is not None else None,
+            'merged': False,
+        })
+    elif name in ('backup', 'forward'):
+        record['duration'] = int(element.find('.//duration').text)
+    elif name == 'attributes':
+        divisions = None
+        attributes = []
+        for child in element:
+            if child.tag == 'divisions':
+                divisions = int(child.text)
+            elif child.tag in ('clef', 'key', 'time'):
+                number = child.get('number')
+                attributes.append((int(number) if number is not None else None,
+                                   attribute_to_token(child)))
+        staves = find_text(element, 'staves')
+        record['divisions'] = divisions
+        record['attributes'] = attributes
+        record['staves'] = int(staves) if staves is not None else None
+
+    return record
+
+
+def aggregate_records(records, staff_mode):
+    '''
+    Notes to chord: move the pitch of every chord note into the previous note.
+    The first note of each (staff, voice) group is left untouched, as in
+    score_to_tokens.aggregate_notes.
+    '''
+    seen_groups = set()
+    last_note = None
+    for record in records:
+        if record['name'] != 'note':
+            continue
+        if staff_mode and record['staff'] not in (1, 2):
+            last_note = record
+            continue
+        if record['voice'] is None:
+            last_note = record
+            continue
+
+        group = (record['staff'] if staff_mode else None, record['voice'])
+        if group not in seen_groups:
+            seen_groups.add(group)
+        elif record['chord'] and last_note is not None and record['pitches']:
+            last_note['pitches'].insert(0, record['pitches'][0])
+            record['merged'] = True
+            continue
+        last_note = record
+
+
+def compute_positions(records):
+    '''
+    Compute the start and end position of each element in the measure
+    '''
+    position = 0
+    last_duration = 0
+    for record in records:
+        name = record['name']
+        if name == 'note':
+            if record['merged']:
+                continue
+            if record['duration'] is None:  # gracenote
+                record['start'] = position
+                record['end'] = position
+                continue
+            if record['chord']:  # rewind for concurrent notes
+                position -= last_duration
+            record['start'] = position
+            position += record['duration']
+            record['end'] = position
+            last_duration = record['duration']
+        elif name == 'backup':
+            position -= record['duration']
+        elif name == 'forward':
+            position += record['duration']
+        else:  # other types
+            record['start'] = position
+            record['end'] = position
+
+
+def new_event_state():
+    return {'divisions': None, 'measure': 0, 'onset': 0.0, 'chord': -1, 'staves': 1}
+
+
+def record_to_flags(record):
+    flags = 0
+    if record['tie'] == 'start':
+        flags |= TIE_START
+    elif record['tie'] == 'stop':
+        flags |= TIE_STOP
+    if record['stem'] == 'up':
+        flags |= STEM_UP
+    elif record['stem'] == 'down':
+        flags |= STEM_DOWN
+    if record['beams']:
+        flags |= BEAM
+    if record['duration'] is None:
+        flags |= GRACE
+    return flags
+
+
+def records_to_events(records, state, staff=None):
+    '''
+    Note event rows of one measure (already aggregated and positioned).
+    state carries divisions, measure index, measure onset and chord ids
+    across the measures of a part. staff overrides the staff of the notes
+    (used for two-part scores).
+    '''
+    rows = []
+    measure_len = 0
+    divisions = state['divisions']
+    for record in records:
+        if 'end' in record:
+            measure_len = max(measure_len, record['end'])
+        if record['name'] == 'attributes':
+            if record['divisions']:
+                divisions = record['divisions']
+            if record.get('staves'):
+                state['staves'] = record['staves']
+            continue
+        if record['name'] != 'note' or record['merged'] or record['rest'] or not record['pitches']:
+            continue
+
+        quarter = 1 / divisions if divisions else 0
+        onset = state['onset'] + record['start'] * quarter
+        duration = record['duration'] * quarter if record['duration'] is not None else 0
+        voice = int(record['voice']) if record['voice'] and record['voice'].isdigit() else 0
+        flags = record_to_flags(record)
+        if not (record['chord'] and rows):  # chord notes that were not aggregated join the previous note
+            state['chord'] += 1
+        for step, alter, octave in reversed(record['pitches']):  # chord notes were prepended
+            pitch = (int(octave) + 1) * 12 + step_to_semitone[step] + \
+                (round(float(alter)) if alter else 0)
+            rows.append((onset, duration, pitch, staff or record['staff'] or 1, voice,
+                         state['chord'], state['measure'], flags))
+
+    state['divisions'] = divisions
+    state['onset'] += measure_len / divisions if divisions else 0
+    state['measure'] += 1
+    return rows
+
+
+def record_attributes_to_tokens(record, staff=None):
+    tokens = []
+    for number, token in record['attributes']:
+        if staff is not None and number is not None and number != staff:
+            continue
+        tokens.append(token)
+    return tokens, record['divisions']
+
+
+def record_note_to_tokens(record, divisions=8, note_name=True):  # notes and rests
+    if record['duration'] is None:  # gracenote
+        return []
+
+    duration_in_fraction = str(Fraction(record['duration'], divisions))
+
+    if record['rest']:
+        return ['rest', f'len_{duration_in_fraction}']  # for rests
+
+    tokens = []
+
+    # pitches
+    for step, alter, octave in record['pitches']:
+        if note_name:
+            if alter is not None:
+                tokens.append(f"note_{step}{alter_to_symbol[alter]}{octave}")
+            else:
+                tokens.append(f"note_{step}{octave}")
+        else:
+            note_number = pretty_midi.note_name_to_number(
+                step + octave)  # 'C4' -> 60
+            if alter is not None:
+                note_number += int(alter)
+            tokens.append(f'note_{note_number}')
+
+    # len
+    tokens.append(f'len_{duration_in_fraction}')
+
+    if record['stem'] is not None:
+        tokens.append(f"stem_{record['stem']}")
+
+    if record['beams']:
+        tokens.append('beam_' + '_'.join([beam_translations[b]
+                      if b in beam_translations else b for b in record['beams']]))
+
+    if record['tie'] is not None:
+        tokens.append('tie_' + record['tie'])
+
+    return tokens
+
+
+def records_to_tokens(records, divisions, staff=None, note_name=True):
+    '''
+    Tokenize the records of one measure (already aggregated and positioned)
+    for the given staff. Returns the tokens and the updated divisions.
+    '''
+    tokens = ['bar']
+
+    def element_to_tokens(record):
+        nonlocal divisions
+        if record['name'] == 'attributes':
+            attr_tokens, div = record_attributes_to_tokens(record, staff)
+            divisions = div if div else divisions
+            return attr_tokens
+        elif record['name'] == 'note':
+            return record_note_to_tokens(record, divisions, note_name)
+        return []
+
+    if staff is not None:
+        notes = [r for r in records if r['name'] ==
+                 'note' and r['staff'] == staff]
+    else:
+        notes = [r for r in records if r['name'] == 'note']
+
+    voices = list(set([n['voice'] for n in notes if n['voice'] is not None]))
+
+    if len(voices) > 1:
+        # divide elements into three sections
+        voice_starts, voice_ends = {}, {}
+        if staff is not None:
+            for n in notes:
+                if n['duration'] is None or n['merged']:
+                    continue
+                voice = n['voice']
+                voice_starts[voice] = min(
+                    voice_starts[voice], n['start']) if voice in voice_starts else n['start']
+                voice_ends[voice] = max(
+                    voice_ends[voice], n['end']) if voice in voice_ends else n['end']
+
+        voice_start = sorted(voice_starts.values())[1] if voice_starts else 0
+        voice_end = sorted(voice_ends.values(), reverse=True)[
+            1] if voice_ends else 0
+
+        pre_voice_elements, post_voice_elements, voice_elements = [], [], []
+        for record in records:
+            if record['name'] in ('backup', 'forward'):
+                continue
+            if record['name'] == 'note' and (record['duration'] is None or record['merged']):
+                continue
+            if staff is not None:
+                if record['staff'] is not None and record['staff'] != staff:
+                    continue
+
+            if voice_starts or voice_ends:
+                if record['end'] <= voice_start:
+                    pre_voice_elements.append(record)
+                elif voice_end <= record['start']:
+                    post_voice_elements.append(record)
+                else:
+                    voice_elements.append(record)
+            else:
+                pre_voice_elements.append(record)
+
+        for record in pre_voice_elements:
+            tokens += element_to_tokens(record)
+
+        if voice_elements:
+            for voice in voices:
+                tokens.append('<voice>')
+                for record in voice_elements:
+                    if record['voice'] == voice or (record['voice'] is None and voice == '1'):
+                        tokens += element_to_tokens(record)
+                tokens.append('</voice>')
+
+        for record in post_voice_elements:
+            tokens += element_to_tokens(record)
+    else:
+        for record in records:
+            if record['name'] == 'note' and record['merged']:
+                continue
+            if staff is not None:
+                if record['name'] in ('attributes', 'note') and record['staff'] is not None and record['staff'] != staff:
+                    continue
+            tokens += element_to_tokens(record)
+
+    return tokens, divisions
+
+
+def split_staves(records, staves=(1, 2)):
+    '''
+    Sort the records of a measure into per-staff buckets in one traversal.
+    Elements without a staff (attributes, barlines...) go to every bucket.
+    '''
+    buckets = {staff: [] for staff in staves}
+    for record in records:
+        if record['staff'] is None:
+            for bucket in buckets.values():
+                bucket.append(record)
+        elif record['staff'] in buckets:
+            buckets[record['staff']].append(record)
+    return buckets
+
+
+def prepare_records(records, staff_mode):
+    aggregate_records(records, staff_mode)
+    compute_positions(records)
+    return records
+
+
+def measure_to_records(measure, staff_mode):
+    records = [element_to_record(e)
+               for e in measure if isinstance(e.tag, str)]  # excluding comments
+    return prepare_records(records, staff_mode)
+
+
+def parse_score(mxml_path, note_name=True, tokens=True, events=False):
+    '''
+    Single streaming pass over a score. Returns the token sequence (if tokens)
+    and the note event array (if events), None for what was not requested.
+    '''
+    n_parts = None
+    part_index = -1
+    R_tokens, L_tokens = [], []
+    R_divisions, L_divisions = 0, 0
+    event_rows = []
+    event_states = [new_event_state(), new_event_state()]
+
+    context = etree.iterparse(mxml_path, events=('start', 'end'),
+                              tag=('part-list', 'part', 'measure'))
+    for event, element in context:
+        if element.tag == 'part-list':
+            if event == 'end':
+                n_parts = len(element.findall('score-part'))
+                if n_parts not in (1, 2):
+                    raise ValueError(
+                        f'Expected 1 or 2 parts, got {n_parts}')
+                element.clear()
+            continue
+        if element.tag == 'part':
+            if event == 'start':
+                part_index += 1
+            continue
+        if event == 'start':
+            continue
+
+        # measure end event
+        if n_parts == 1:
+            records = measure_to_records(element, staff_mode=True)
+            if tokens:
+                buckets = split_staves(records)
+                measure_tokens, R_divisions = records_to_tokens(
+                    buckets[1], R_divisions, staff=1, note_name=note_name)
+                R_tokens += measure_tokens
+                measure_tokens, L_divisions = records_to_tokens(
+                    buckets[2], L_divisions, staff=2, note_name=note_name)
+                L_tokens += measure_tokens
+            if events:
+                event_rows += records_to_events(records, event_states[0])
+        elif part_index in (0, 1):
+            records = measure_to_records(element, staff_mode=False)
+            if tokens and part_index == 0:
+                measure_tokens, R_divisions = records_to_tokens(
+                    records, R_divisions, note_name=note_name)
+                R_tokens += measure_tokens
+            elif tokens:
+                measure_tokens, L_divisions = records_to_tokens(
+                    records, L_divisions, note_name=note_name)
+                L_tokens += measure_tokens
+            if events:
+                event_rows += records_to_events(records, event_states[part_index],
+                                                staff=part_index + 1)
+
+        # free the measure and the already processed siblings
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    del context
+
+    if n_parts is None or part_index + 1 != n_parts:
+        raise ValueError(
+            f'Expected {n_parts} parts, got {part_index + 1}')
+
+    if events and n_parts == 1 and event_states[0]['staves'] != 2:
+        raise ValueError('Expected a piano score with two staves')
+    if events and n_parts == 2 and max(s['staves'] for s in event_states) > 1:
+        raise ValueError('Expected a piano score with one staff per part')
+
+    return (['R'] + R_tokens + ['L'] + L_tokens if tokens else None,
+            np.array(event_rows, dtype=note_event_dtype) if events else None)
+
+
+def MusicXML_to_tokens_stream(mxml_path, note_name=True, with_events=False):  # use this method
+    '''
+    Streaming equivalent of score_to_tokens.MusicXML_to_tokens
+    mxml_path can be a path or a file object
+    With with_events=True, returns (tokens, note events) from the same pass
+    '''
+    tokens, events = parse_score(mxml_path, note_name, tokens=True, events=with_events)
+    if with_events:
+        return tokens, events
+    return tokens
+
+
+def MusicXML_to_events(mxml_path):
+    '''
+    Note event array of a score (see note_event_dtype), right hand is staff 1
+    '''
+    return parse_score(mxml_path, tokens=False, events=True)[1]
@@ -3,8 +3,10 @@ from difflib import SequenceMatcher
 from datasketch import MinHash, MinHashLSH
 import os
 from tqdm import tqdm
-import pickle
 import concurrent.futures
+import note_events
+import instrumentation
+import columnar
 
 def get_chord_pitches(chord):
     notes = chord.notes
@@ -45,13 +47,20 @@ def get_piano_pitches(path, is_right_hand=True):
         return None
     return (path, midi)
 
-def process_pitches(path_list, output_file, is_right_hand=True, num_threads=os.cpu_count()):
+def process_pitches(path_list, output_file, is_right_hand=True, num_threads=os.cpu_count(), use_events=False):
+    '''
+    use_events: read the pitches from the note event arrays (single lxml pass)
+    instead of parsing every file with music21
+    '''
     pitches_list = []
+    get_pitches = note_events.get_piano_pitches if use_events else get_piano_pitches
+    get_pitches = instrumentation.traced('process_pitches', get_pitches, instrumentation.is_none)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    with instrumentation.stage('process_pitches', len(path_list)), \
+            concurrent.futures.ThreadPoolExecutor() as executor:
         progress_bar = tqdm(total=len(path_list))
 
-        futures = [executor.submit(get_piano_pitches, path, is_right_hand) for path in path_list]
+        futures = [executor.submit(get_pitches, path, is_right_hand) for path in path_list]
         for future in concurrent.futures.as_completed(futures):
             result = future.result()
             progress_bar.update(1)
@@ -61,8 +70,7 @@ def process_pitches(path_list, output_file, is_right_hand=True, num_threads=os.c
 
         progress_bar.close()
 
-    with open(output_file, 'wb') as f:
-        pickle.dump(pitches_list, f)
+    columnar.save_pitches(output_file, pitches_list)
 
     print(f'Computed {len(pitches_list)} scores for pitches')
 
@@ -70,6 +78,11 @@ def process_pitches(path_list, output_file, is_right_hand=True, num_threads=os.c
 
 
 def compute_similarity(l1, l2):
+    # pitches read from a columnar table are uint8 arrays
+    if hasattr(l1, 'tolist'):
+        l1 = l1.tolist()
+    if hasattr(l2, 'tolist'):
+        l2 = l2.tolist()
     len1, len2 = len(l1), len(l2)
     len_diff = abs(len1 - len2)
     max_len = max(len1, len2)
@@ -102,9 +115,12 @@ def sort_pitches(pitches):
     return sorted(pitches, key=lambda x: len(x[1]), reverse=True)
 
 def process_similarity(pitch_path='./data/pitches.pkl', threshold=0.01):
-    with open(pitch_path, 'rb') as f:
-        pitches = pickle.load(f)
+    pitches = columnar.load_pitches(pitch_path)
 
+    with instrumentation.stage('process_similarity', len(pitches)):
+        return remove_similar(pitches, threshold)
+
+def remove_similar(pitches, threshold):
     # Longer files are first
     pitches = sort_pitches(pitches)
 
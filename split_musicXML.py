@@ -6,9 +6,14 @@ from tqdm import tqdm
 import glob
 import numpy as np
 import pandas as pd
-from score_to_tokens import MusicXML_to_tokens
+from score_to_tokens_stream import MusicXML_to_tokens_stream
+from batch_tokenize import tokenize_batch, write_failure_manifest
+import manifest as pipeline_manifest
+import file_catalog
+import instrumentation
+import columnar
+import note_events
 from create_vocab import *
-import pickle
 
 """
 Split a MusicXML file into multiple by n bars
@@ -25,7 +30,7 @@ def dir_path(string):
     else:
         raise NotADirectoryError(string)
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -79,7 +84,91 @@ def parse_args():
         default='mapped/score_transformers_vocab.txt'
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--token_fragments',
+        dest='token_fragments',
+        action='store_true',
+        help="Tokenize every score once and cut the fragments from the token streams "
+             "instead of writing fragment MusicXML files"
+    )
+
+    parser.add_argument(
+        '--binary',
+        dest='binary',
+        action='store_true',
+        help="Write mapped fragments as .npy ID arrays instead of text files"
+    )
+
+    parser.add_argument(
+        '--packed',
+        dest='packed',
+        type=str,
+        help="Also write a packed, memory-mapped dataset to this directory",
+        nargs='?',
+        default=None
+    )
+
+    parser.add_argument(
+        '--shard_size',
+        dest='shard_size',
+        type=int,
+        help="Number of samples per shard of the packed dataset",
+        default=100000
+    )
+
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        help="Number of tokenization processes",
+        default=os.cpu_count()
+    )
+
+    parser.add_argument(
+        '--chunksize',
+        dest='chunksize',
+        type=int,
+        help="Number of files sent to a tokenization process at once",
+        default=16
+    )
+
+    parser.add_argument(
+        '--failures',
+        dest='failures',
+        type=str,
+        help="JSONL manifest of the files that failed to tokenize",
+        default='data/tokenize_failures.jsonl'
+    )
+
+    parser.add_argument(
+        '--cache',
+        dest='cache',
+        type=str,
+        help="Token cache database, tokenization results are reused across runs",
+        nargs='?',
+        default=None
+    )
+
+    parser.add_argument(
+        '--cache_size',
+        dest='cache_size',
+        type=int,
+        help="Maximum size of the token cache in MB",
+        default=4096
+    )
+
+    parser.add_argument(
+        '--manifest',
+        dest='manifest',
+        type=str,
+        help="Pipeline manifest (see manifest.py) to record the tokenized and failed scores in",
+        nargs='?',
+        default=None
+    )
+
+    instrumentation.add_arguments(parser)
+
+    return parser.parse_args(argv)
 
 
 def split_in_fragments(score_path, output_dir, fragment_size, difficulty_dict):
@@ -124,11 +213,91 @@ def split_in_fragments(score_path, output_dir, fragment_size, difficulty_dict):
     return fragment_paths, difficulty_dict
 
 
-def create_complexity_all(fragments_path):
+def get_fragment_path(output_dir, score_path, fragment_idx, difficulty):
+    filename = os.path.basename(score_path)
+    return f'{output_dir}/{filename}'.split('.')[0] \
+        + '_fragment_' + str(fragment_idx) \
+        + '_d_' + str(difficulty) \
+        + '.musicxml'
+
+
+def attribute_kind(token):
+    if token is None:
+        return None
+    kind = token.split('_')[0]
+    return kind if kind in ('key', 'time', 'clef') else None
+
+
+def split_hand_tokens(tokens, fragment_size):
+    '''
+    Cut the tokens of one hand into fragments of fragment_size bars.
+    The clef, key and time signature in effect at the start of each fragment
+    are added to its first bar when the bar does not set them itself.
+    '''
+    bars = [i for i, t in enumerate(tokens) if t == 'bar'] + [len(tokens)]
+    n_bars = len(bars) - 1
+
+    fragments = []
+    state = {}
+    scanned = 0
+    for idx in range(0, n_bars - fragment_size + 1, fragment_size):
+        start, end = bars[idx], bars[idx + fragment_size]
+        for t in tokens[scanned:start]:
+            kind = attribute_kind(t)
+            if kind is not None:
+                state[kind] = t
+        scanned = start
+
+        # attributes set at the very beginning of the first bar
+        own_kinds = set()
+        for t in tokens[start + 1:bars[idx + 1]]:
+            kind = attribute_kind(t)
+            if kind is None:
+                break
+            own_kinds.add(kind)
+
+        carried = [state[kind] for kind in ('key', 'time', 'clef')
+                   if kind in state and kind not in own_kinds]
+        fragments.append(['bar'] + carried + tokens[start + 1:end])
+
+    return fragments
+
+
+def split_tokens_in_fragments(score_path, tokens, output_dir, fragment_size, difficulty_dict):
+    '''
+    Token-space equivalent of split_in_fragments: the fragments are cut from the
+    R/L token streams of the tokenized score, no fragment file is written.
+    Returns a list of (fragment path, token sequence) with the difficulty token.
+    '''
+    L_index = tokens.index('L')
+    R_fragments = split_hand_tokens(tokens[1:L_index], fragment_size)
+    L_fragments = split_hand_tokens(tokens[L_index + 1:], fragment_size)
+
+    difficulty = difficulty_dict.get(score_path)
+    tokens_list = []
+    for i, (R, L) in enumerate(zip(R_fragments, L_fragments)):
+        path = get_fragment_path(output_dir, score_path, i, difficulty)
+        sequence = get_difficulty_token(difficulty) + ['R'] + R + ['L'] + L
+        tokens_list.append((path, sequence))
+
+    return tokens_list
+
+
+def create_complexity_all(fragments_path, use_events=False, catalog=None):
     df = pd.DataFrame(columns=['complexity'])
-    for filepath in tqdm(glob.glob(fragments_path + '/*')):
-        fragment = converter.parse(filepath)
-        complexity = compute_complexity(fragment)
+    if catalog is not None:
+        file_catalog.refresh(catalog, fragments_path, 'fragments')
+        root = os.path.normpath(fragments_path)
+        filepaths = [path for path in file_catalog.get_files(catalog, 'fragments')
+                     if os.path.dirname(path) == root]
+    else:
+        filepaths = glob.glob(fragments_path + '/*')
+    for filepath in tqdm(filepaths):
+        if use_events:
+            complexity = note_events.compute_complexity(filepath)
+        else:
+            fragment = converter.parse(filepath)
+            complexity = compute_complexity(fragment)
         df.loc[filepath] = complexity
 
     return df
@@ -166,37 +335,96 @@ def get_difficulty_token(difficulty):
 
     return diff_dict[difficulty]
 
-def main():
-    args = parse_args()
-
-    with open(args.difficulty, 'rb') as f:
-        difficulty_dict = create_tuple_dictionary(pickle.load(f))
+def tokenize_dataset(args):
+    '''
+    Split the scores of the difficulty file into fragments and tokenize them,
+    returns the (fragment path, tokens) list
+    '''
+    difficulty_dict = create_tuple_dictionary(columnar.load_rows(args.difficulty))
 
     musicxml_paths = list(difficulty_dict.keys())
 
-    filepaths = []
-    for filename in tqdm(musicxml_paths, 'Splitting musicxml score into fragments'):
-        current_fragment_paths, difficulty_dict = split_in_fragments(filename, args.output, args.bars, difficulty_dict)
-        filepaths.extend(current_fragment_paths)
+    cache_size = args.cache_size * 1024 ** 2
 
     tokens_list = []
-    for path in tqdm(filepaths):
-        try:
-            sub_list = MusicXML_to_tokens(path)
+    score_failures = {}  # score name -> reason
+    if args.token_fragments:
+        # every score is tokenized once across the process pool, the fragments are cut from its tokens
+        score_paths = [os.path.join(args.dir, filename) for filename in musicxml_paths]
+        results, failures = tokenize_batch(score_paths, args.workers, args.chunksize, cache_path=args.cache,
+                                           cache_size=cache_size, tokenizer=MusicXML_to_tokens_stream)
+        tokens_by_path = dict(results)
+        with instrumentation.stage('split_tokens_in_fragments', len(results)):
+            for filename, path in zip(musicxml_paths, score_paths):
+                if path not in tokens_by_path:
+                    continue
+                fragments = split_tokens_in_fragments(filename, tokens_by_path[path], args.output, args.bars,
+                                                      difficulty_dict)
+                if not fragments:
+                    score_failures[os.path.basename(filename)] = 'tokenize: no fragment'
+                tokens_list.extend(fragments)
+
+        write_failure_manifest(failures, args.failures)
+        print(f'{len(failures)} score(s) failed to tokenize, see {args.failures}')
+        for failure in failures:
+            score_failures[os.path.basename(failure['path'])] = f"tokenize: {failure['error']}: {failure['message']}"
+    else:
+        filepaths = []
+        fragment_scores = {}
+        split = instrumentation.traced('split_in_fragments', split_in_fragments)
+        with instrumentation.stage('split_in_fragments', len(musicxml_paths)):
+            for filename in tqdm(musicxml_paths, 'Splitting musicxml score into fragments'):
+                current_fragment_paths, difficulty_dict = split(filename, args.output, args.bars, difficulty_dict)
+                filepaths.extend(current_fragment_paths)
+                for path in current_fragment_paths:
+                    fragment_scores[path] = os.path.basename(filename)
+
+        results, failures = tokenize_batch(filepaths, args.workers, args.chunksize,
+                                           cache_path=args.cache, cache_size=cache_size)
+        for path, sub_list in results:
             if sub_list is not None:
                 difficulty = difficulty_dict[path]
                 sequence = get_difficulty_token(difficulty) + sub_list
                 tokens_list.append((path, sequence))
-        except Exception as e:
-            continue
 
+        write_failure_manifest(failures, args.failures)
+        print(f'{len(failures)} fragment(s) failed to tokenize, see {args.failures}')
+        for failure in failures:
+            score_failures.setdefault(fragment_scores[failure['path']],
+                                      f"tokenize: {failure['error']}: {failure['message']}")
+
+    if args.manifest is not None:
+        manifest = pipeline_manifest.open_manifest(args.manifest)
+        names = [os.path.basename(path) for path in musicxml_paths]
+        pipeline_manifest.set_status(manifest, [n for n in names if n not in score_failures],
+                                     pipeline_manifest.TOKENIZED, by='name')
+        pipeline_manifest.set_status(manifest, list(score_failures), pipeline_manifest.FAILED,
+                                     list(score_failures.values()), by='name')
+    return tokens_list
+
+
+def write_vocab(tokens_list, args):
+    '''
+    Write the vocabulary and the mapped dataset of the tokenized fragments
+    '''
     unique_tokens = get_unique_strings(tokens_list)
 
     os.makedirs(args.mapped, exist_ok=True)
 
     write_to_file(unique_tokens, args.vocab)
 
-    create_mappings(args.mapped, tokens_list, unique_tokens)
+    create_mappings(args.mapped, tokens_list, unique_tokens, args.binary)
+
+    if args.packed is not None:
+        from packed_dataset import write_packed_dataset
+        write_packed_dataset(args.packed, tokens_list, Vocabulary(unique_tokens), args.shard_size)
+
+
+def main():
+    args = parse_args()
+    instrumentation.configure(args.trace, args.profile_rate, args.profile_dir)
+    tokens_list = tokenize_dataset(args)
+    write_vocab(tokens_list, args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,92 @@
+import os
+import concurrent.futures
+from lxml import etree
+from tqdm import tqdm
+import instrumentation
+
+"""
+Structural validation of MusicXML piano files without music21
+
+Same criterion as process_musescore.is_piano: the score has two staves
+(two parts, or one part with <staves>2</staves>, as music21 splits a
+two-staff part into two PartStaff) and no part without measures.
+The file is scanned with lxml.etree.iterparse, measures are freed as soon
+as they are counted and the scan stops at the first element that makes
+the file invalid.
+"""
+
+REQUIRED_STAVES = 2
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+
+def scan_structure(path):
+    '''
+    Returns (valid, counts, reason), counts: parts, staves, measures and notes seen
+    '''
+    counts = {'parts': 0, 'staves': 0, 'measures': 0, 'notes': 0}
+    declared_parts = 0
+    part_staves, part_measures = 1, 0
+    in_part = False
+    try:
+        for event, elem in etree.iterparse(path, events=('start', 'end'), huge_tree=True,
+                                           resolve_entities=False, no_network=True):
+            tag = local_name(elem.tag)
+            if event == 'start':
+                if tag == 'part':
+                    in_part = True
+                    part_staves, part_measures = 1, 0
+                    counts['parts'] += 1
+                    if counts['parts'] > REQUIRED_STAVES:
+                        return False, counts, 'more than two parts'
+                continue
+
+            if tag == 'score-part':
+                declared_parts += 1
+                if declared_parts > REQUIRED_STAVES:
+                    return False, counts, 'more than two parts'
+            elif tag == 'staves' and in_part and part_measures == 0:
+                part_staves = int(elem.text)
+            elif tag == 'note':
+                counts['notes'] += 1
+            elif tag == 'measure':
+                if part_measures == 0:  # staves are declared in the first measure
+                    counts['staves'] += part_staves
+                    if counts['staves'] > REQUIRED_STAVES:
+                        return False, counts, 'more than two staves'
+                part_measures += 1
+                counts['measures'] += 1
+                elem.clear()
+            elif tag == 'part':
+                in_part = False
+                if part_measures == 0:
+                    return False, counts, 'empty staff'
+                elem.clear()
+    except (etree.XMLSyntaxError, ValueError, OSError) as e:
+        return False, counts, f'{type(e).__name__}: {e}'
+
+    if counts['staves'] != REQUIRED_STAVES:
+        return False, counts, f"{counts['staves']} staves"
+    return True, counts, None
+
+
+def check_file(path):
+    '''
+    Same contract as process_musescore.is_piano: the path if valid, else None
+    '''
+    valid, _, _ = scan_structure(path)
+    return path if valid else None
+
+
+def filter_structure(paths, num_workers=os.cpu_count(), chunksize=64):
+    '''
+    Validate paths across num_workers processes, returns path or None per input (input order)
+    '''
+    check = instrumentation.traced('filter_empty', check_file, instrumentation.is_none)
+    if num_workers is None or num_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return list(tqdm(executor.map(check, paths, chunksize=chunksize),
+                             'Filtering', total=len(paths)))
+    return [check(path) for path in tqdm(paths, 'Filtering')]
@@ -0,0 +1,128 @@
+import os
+import json
+import zlib
+import time
+import sqlite3
+import hashlib
+from score_to_tokens import TOKENIZER_VERSION
+
+"""
+Content-addressed on-disk cache of token sequences
+
+Entries are keyed by the SHA-256 of the MusicXML file and a fingerprint of the
+tokenizer version and options, so an entry is reused as long as neither the
+file nor the tokenizer changed. The cache is a SQLite database in WAL mode:
+every process opens its own connection, readers and writers can run
+concurrently. When the stored tokens exceed max_bytes, the least recently
+used entries are evicted. The access time of an entry is only updated when
+older than ACCESS_INTERVAL, so that a cache hit is a read and the workers
+do not queue on the writer lock.
+"""
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+ACCESS_INTERVAL = 3600  # seconds, resolution of the LRU access times
+
+
+def options_fingerprint(note_name=True):
+    return f'v{TOKENIZER_VERSION}-note_name={int(note_name)}'
+
+
+def file_key(path, note_name=True, block_size=1 << 20):
+    '''
+    Cache key of a MusicXML file: content hash + tokenizer fingerprint
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest() + '-' + options_fingerprint(note_name)
+
+
+def open_cache(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('''CREATE TABLE IF NOT EXISTS tokens (
+                        key TEXT PRIMARY KEY,
+                        data BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_access REAL NOT NULL)''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS tokens_last_access ON tokens (last_access)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                        name TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL)''')
+    conn.execute(
+        "INSERT OR IGNORE INTO meta (name, value) VALUES ('total_size', 0)")
+    conn.execute('COMMIT')
+    return conn
+
+
+def get_tokens(conn, key):
+    '''
+    Return the cached tokens for key, or None on a cache miss
+    '''
+    row = conn.execute(
+        'SELECT data, last_access FROM tokens WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if now - row[1] > ACCESS_INTERVAL:
+        conn.execute('UPDATE tokens SET last_access = ? WHERE key = ?',
+                     (now, key))
+    return json.loads(zlib.decompress(row[0]))
+
+
+def put_tokens(conn, key, tokens, max_bytes=DEFAULT_MAX_BYTES):
+    data = zlib.compress(json.dumps(tokens).encode('utf-8'))
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            'SELECT size FROM tokens WHERE key = ?', (key,)).fetchone()
+        old_size = row[0] if row is not None else 0
+        conn.execute('INSERT OR REPLACE INTO tokens (key, data, size, last_access) VALUES (?, ?, ?, ?)',
+                     (key, data, len(data), time.time()))
+        conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_size'",
+                     (len(data) - old_size,))
+        evict(conn, max_bytes)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def evict(conn, max_bytes):
+    '''
+    Remove least recently used entries until the cache fits in max_bytes
+    (called inside the write transaction of put_tokens)
+    '''
+    total_size = conn.execute(
+        "SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+    excess = total_size - max_bytes
+    if excess <= 0:
+        return
+
+    to_remove, freed = [], 0
+    for key, size in conn.execute('SELECT key, size FROM tokens ORDER BY last_access'):
+        if freed >= excess:
+            break
+        to_remove.append((key,))
+        freed += size
+    conn.executemany('DELETE FROM tokens WHERE key = ?', to_remove)
+    conn.execute("UPDATE meta SET value = value - ? WHERE name = 'total_size'",
+                 (freed,))
+
+
+def cached_tokenize(conn, path, tokenizer, note_name=True, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Tokenize path with tokenizer(path, note_name=...) unless the result is cached
+    '''
+    key = file_key(path, note_name)
+    tokens = get_tokens(conn, key)
+    if tokens is None:
+        tokens = tokenizer(path, note_name=note_name)
+        put_tokens(conn, key, tokens, max_bytes)
+    return tokens
@@ -0,0 +1,170 @@
+import numpy as np
+from create_vocab import Vocabulary
+
+"""
+Finite-state grammar of the token sequences, for constrained decoding
+
+A sequence is: [difficulty token] R bar ... L bar ... [EOS]
+- every hand starts with a bar, the left hand is mandatory
+- note and rest tokens must be followed by a len token (several note tokens
+  form a chord, a rest is directly followed by its len)
+- len, stem, beam and tie tokens only belong to a note or rest group
+- </voice> closes an open <voice>, voices cannot be nested and bar, L and
+  EOS are only allowed outside of a voice and after a complete note group
+
+These are the conditions under which tokens_to_score decodes a sequence
+without error. TokenGrammar precomputes the transitions between states for
+each token class and the boolean mask of allowed tokens for each state,
+so a batch of states is updated and masked with array indexing only.
+"""
+
+# token classes
+OTHER, R, L, BAR, VOICE_OPEN, VOICE_CLOSE, ATTRIBUTE, NOTE, REST, LEN, ORNAMENT, EOS = range(12)
+N_CLASSES = 12
+
+# phases of a sequence
+START, PREFIX, R_START, R_MEASURE, L_START, L_MEASURE, END, DEAD = range(8)
+# note group state in a measure
+NO_GROUP, AFTER_NOTE, AFTER_REST, AFTER_LEN = range(4)
+
+
+def token_class(token):
+    kind = token.split('_')[0]
+    if token in ('R', 'L', 'bar', '<voice>', '</voice>'):
+        return {'R': R, 'L': L, 'bar': BAR, '<voice>': VOICE_OPEN, '</voice>': VOICE_CLOSE}[token]
+    elif kind in ('clef', 'key', 'time'):
+        return ATTRIBUTE
+    elif kind == 'note':
+        return NOTE
+    elif kind == 'rest':
+        return REST
+    elif kind in ('len', 'attr'):
+        return LEN
+    elif kind in ('stem', 'dir', 'beam', 'tie'):
+        return ORNAMENT
+    return OTHER
+
+
+def state_id(phase, group=NO_GROUP, voice=False):
+    return phase * 8 + group * 2 + int(voice)
+
+
+def state_fields(state):
+    return state // 8, (state % 8) // 2, bool(state % 2)
+
+
+def next_state(state, cls):
+    '''
+    State after a token of class cls, or the dead state
+    '''
+    phase, group, voice = state_fields(state)
+    dead = state_id(DEAD)
+
+    if phase == START:
+        if cls == OTHER:
+            return state_id(PREFIX)
+        return state_id(R_START) if cls == R else dead
+    if phase == PREFIX:
+        return state_id(R_START) if cls == R else dead
+    if phase in (R_START, L_START):
+        return state_id(phase + 1) if cls == BAR else dead
+    if phase in (END, DEAD):
+        return state_id(END) if cls == EOS and phase == END else dead
+
+    # in a measure
+    if group in (AFTER_NOTE, AFTER_REST):
+        if cls == LEN:
+            return state_id(phase, AFTER_LEN, voice)
+        elif group == AFTER_NOTE and cls in (NOTE, ORNAMENT):
+            return state
+        return dead
+
+    if cls == NOTE:
+        return state_id(phase, AFTER_NOTE, voice)
+    elif cls == REST:
+        return state_id(phase, AFTER_REST, voice)
+    elif cls in (LEN, ORNAMENT):
+        return state if group == AFTER_LEN else dead
+    elif cls == ATTRIBUTE:
+        return state_id(phase, NO_GROUP, voice)
+    elif cls == VOICE_OPEN:
+        return dead if voice else state_id(phase, NO_GROUP, True)
+    elif cls == VOICE_CLOSE:
+        return state_id(phase, NO_GROUP, False) if voice else dead
+    elif voice:
+        return dead
+    elif cls == BAR:
+        return state_id(phase)
+    elif cls == L:
+        return state_id(L_START) if phase == R_MEASURE else dead
+    elif cls == EOS:
+        return state_id(END) if phase == L_MEASURE else dead
+    return dead
+
+
+class TokenGrammar:
+    '''
+    transitions[state, class] -> state and masks[state, token ID] -> allowed,
+    both computed once per vocabulary. eos_id is the ID of the end of sequence
+    token of the model, it can be outside of the vocabulary.
+    '''
+
+    n_states = state_id(DEAD) + 1
+
+    def __init__(self, vocab, eos_id=None):
+        if isinstance(vocab, str):
+            vocab = Vocabulary.from_file(vocab)
+        elif not isinstance(vocab, Vocabulary):
+            vocab = Vocabulary(vocab)
+        self.vocab = vocab
+        self.eos_id = eos_id
+
+        size = len(vocab) if eos_id is None else max(len(vocab), eos_id + 1)
+        self.token_classes = np.full(size, OTHER, dtype=np.int8)
+        self.token_classes[:len(vocab)] = [token_class(t) for t in vocab.id_to_token]
+        if eos_id is not None:
+            self.token_classes[eos_id] = EOS
+
+        self.transitions = np.array([[next_state(s, c) for c in range(N_CLASSES)]
+                                     for s in range(self.n_states)], dtype=np.int16)
+        allowed_classes = self.transitions != state_id(DEAD)
+        self.masks = allowed_classes[:, self.token_classes]
+
+        self.complete = np.zeros(self.n_states, dtype=bool)
+        self.complete[[state_id(L_MEASURE, NO_GROUP), state_id(L_MEASURE, AFTER_LEN), state_id(END)]] = True
+
+    def initial_states(self, batch_size):
+        return np.full(batch_size, state_id(START), dtype=np.int16)
+
+    def allowed(self, states):
+        '''
+        Boolean mask (batch, vocabulary) of the tokens allowed after each state
+        '''
+        return self.masks[states]
+
+    def apply(self, logits, states, fill=-np.inf):
+        '''
+        Logits (batch, vocabulary) with the disallowed tokens set to fill
+        '''
+        return np.where(self.masks[states][:, :logits.shape[-1]], logits, fill)
+
+    def update(self, states, ids):
+        '''
+        States after one token per sequence, invalid tokens lead to the dead state
+        '''
+        return self.transitions[states, self.token_classes[ids]]
+
+    def is_dead(self, states):
+        return states == state_id(DEAD)
+
+    def is_complete(self, states):
+        '''
+        Whether the sequences can end here and be decoded
+        '''
+        return self.complete[states]
+
+    def accepts(self, ids):
+        state = state_id(START)
+        for cls in self.token_classes[np.asarray(ids)]:
+            state = self.transitions[state, cls]
+        return bool(self.complete[state])
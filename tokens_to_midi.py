@@ -0,0 +1,109 @@
+from fractions import Fraction
+import pretty_midi
+from score_to_tokens_stream import step_to_semitone
+from tokens_to_musicxml import split_hands, parse_hand, hand_measures_layout, time_signature
+
+"""
+Token sequence to MIDI with pretty_midi, without building a music21 score
+
+Onsets come from the same layout as the direct MusicXML writer
+(tokens_to_musicxml): len_ durations, <voice> blocks starting at the same
+position, and the measure length being the end of the longest hand.
+Tied notes of the same pitch are merged into a single MIDI note.
+Each hand is written as a piano instrument.
+"""
+
+DEFAULT_TEMPO = 120
+DEFAULT_VELOCITY = 80
+
+
+def pitch_to_midi(pitch):
+    step, alter, octave = pitch
+    return (octave + 1) * 12 + step_to_semitone[step] + alter
+
+
+def measure_length(time_token):
+    beats, beat_type = time_signature(time_token)
+    return Fraction(4 * beats, beat_type)
+
+
+def hands_to_notes(hands):
+    '''
+    Parsed hands (tokens_to_musicxml.parse_hand) to lists of
+    (onset, end, MIDI pitch) in quarter lengths, one list per hand
+    '''
+    notes = [[], []]
+    open_ties = [{}, {}]
+    start = Fraction(0)
+    default_length = Fraction(4)
+    for m in range(max(len(hands[0]), len(hands[1]))):
+        length = Fraction(0)
+        for hand, measures in enumerate(hands):
+            measure = measures[m] if m < len(measures) else []
+            placed, end = hand_measures_layout(measure, base_voice=1)
+            length = max(length, end)
+            for position, _, item in placed:
+                if item[0] == 'attributes':
+                    if item[1].startswith('time'):
+                        default_length = measure_length(item[1])
+                    continue
+                onset = start + position
+                for note in item[1]:
+                    for pitch in note['pitches']:
+                        add_note(notes[hand], open_ties[hand], onset, note['length'],
+                                 pitch_to_midi(pitch), note['tie'])
+                    onset += note['length']
+        start += length or default_length
+    return notes
+
+
+def add_note(notes, open_ties, onset, length, midi, tie):
+    if tie in ('stop', 'continue') and midi in open_ties:
+        index = open_ties[midi]
+        notes[index][1] = onset + length
+    else:
+        index = len(notes)
+        notes.append([onset, onset + length, midi])
+
+    if tie in ('start', 'continue'):
+        open_ties[midi] = index
+    else:
+        open_ties.pop(midi, None)
+
+
+def tokens_to_midi(string, tempo=DEFAULT_TEMPO, velocity=DEFAULT_VELOCITY):
+    '''
+    Token sequence (string) to a pretty_midi.PrettyMIDI object
+    '''
+    R_tokens, L_tokens = split_hands(string)
+    hands = [parse_hand(R_tokens), parse_hand(L_tokens)]
+    seconds_per_quarter = 60 / tempo
+
+    midi = pretty_midi.PrettyMIDI(initial_tempo=tempo)
+    for name, hand_notes in zip(('Right hand', 'Left hand'), hands_to_notes(hands)):
+        instrument = pretty_midi.Instrument(program=0, name=name)
+        for onset, end, pitch in hand_notes:
+            if end > onset and 0 <= pitch < 128:
+                instrument.notes.append(pretty_midi.Note(
+                    velocity=velocity, pitch=pitch,
+                    start=float(onset) * seconds_per_quarter, end=float(end) * seconds_per_quarter))
+        midi.instruments.append(instrument)
+    return midi
+
+
+def write_midi(string, path, tempo=DEFAULT_TEMPO):
+    tokens_to_midi(string, tempo).write(path)
+
+
+def tokens_to_midi_batch(strings, tempo=DEFAULT_TEMPO):
+    '''
+    (midi, error) pair per sequence: error is None on success, otherwise midi is None and error
+    holds the exception type and message, as in the failure records of mapping_to_mxl
+    '''
+    results = []
+    for string in strings:
+        try:
+            results.append((tokens_to_midi(string, tempo), None))
+        except Exception as e:
+            results.append((None, {'error': type(e).__name__, 'message': str(e)}))
+    return results
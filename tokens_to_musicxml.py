@@ -0,0 +1,526 @@
+import os
+import math
+import argparse
+from fractions import Fraction
+from tqdm import tqdm
+
+"""
+Direct token to MusicXML writer (no music21)
+
+Decodes a token sequence the same way as tokens_to_score.tokens_to_score
+but writes the MusicXML text directly: a single part with two staves,
+divisions computed from the len_ fractions, <backup> between voices and
+staves, and accidentals resolved from the key signature.
+
+python tokens_to_musicxml.py --check DIR compares the notes written by this
+decoder with the ones written by the music21 path for every score of DIR.
+"""
+
+sharp_order = ['F', 'C', 'G', 'D', 'A', 'E', 'B']
+midi_names_sharp = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+midi_names_flat = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
+# music21 default spelling, used in C major / A minor
+midi_names_natural = ['C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'G#', 'A', 'Bb', 'B']
+accidental_symbols = {'': 0, '#': 1, '##': 2, 'b': -1, 'bb': -2, '-': -1, '--': -2}
+accidental_names = {-2: 'flat-flat', -1: 'flat', 0: 'natural', 1: 'sharp', 2: 'double-sharp'}
+beam_names = {'start': 'begin', 'stop': 'end', 'continue': 'continue',
+              'partial-right': 'forward hook', 'partial-left': 'backward hook'}
+note_types = [(Fraction(4), 'whole'), (Fraction(2), 'half'), (Fraction(1), 'quarter'),
+              (Fraction(1, 2), 'eighth'), (Fraction(1, 4), '16th'), (Fraction(1, 8), '32nd'),
+              (Fraction(1, 16), '64th'), (Fraction(1, 32), '128th')]
+tuplet_ratios = [(3, 2), (5, 4), (6, 4), (7, 4), (9, 8)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the direct MusicXML writer with music21')
+    parser.add_argument('--check', type=str, required=True,
+                        help='Directory of MusicXML files to tokenize and decode with both paths')
+    return parser.parse_args()
+
+
+def expand_tokens(tokens):
+    '''
+    Same as tokens_to_score.concatenated_to_regular
+    '''
+    regular_tokens = []
+    for t in tokens:
+        if t.startswith('len') or t.startswith('attr'):
+            attrs = t.split('_')
+            regular_tokens.append(f'len_{attrs[1]}')
+            if len(attrs) >= 3:
+                regular_tokens.append(f'stem_{attrs[2]}')
+            if len(attrs) >= 4:
+                regular_tokens.append(f'beam_{"_".join(attrs[3:])}')
+        else:
+            regular_tokens.append(t)
+    return regular_tokens
+
+
+def split_hands(string):
+    tokens = expand_tokens(string.split())
+    R_index = tokens.index('R')
+    if 'L' in tokens:
+        L_index = tokens.index('L')
+        return tokens[R_index + 1:L_index], tokens[L_index + 1:]
+    return tokens[R_index + 1:], []
+
+
+def parse_length(t):
+    return Fraction(t.split('_')[1])
+
+
+def group_tokens(tokens):
+    '''
+    Aggregate note(rest)-related tokens like tokens_to_score.aggr_note_token,
+    a group is a list of tokens, other tokens are returned as strings
+    '''
+    notes, out = [], []
+    note_flag, len_flag = False, False
+
+    for t in tokens:
+        kind = t.split('_')[0]
+        if kind in ('note', 'rest'):
+            if note_flag and len_flag and notes:
+                out.append(notes)
+                notes = []
+            note_flag = True
+            len_flag = False
+            notes.append(t)
+        elif kind == 'len':
+            len_flag = True
+            notes.append(t)
+        elif kind in ('stem', 'beam', 'tie'):
+            notes.append(t)
+        else:
+            if notes:
+                out.append(notes)
+                notes = []
+            out.append(t)
+    if notes:
+        out.append(notes)
+    return out
+
+
+def key_fifths(token):
+    parts = token.split('_')
+    if parts[1] == 'sharp':
+        return int(parts[2])
+    elif parts[1] == 'flat':
+        return -int(parts[2])
+    return 0
+
+
+def time_signature(token):
+    value = token.split('_')[1]
+    if '/' in value:
+        beats, beat_type = value.split('/')
+        return int(beats), int(beat_type)
+    return int(value), 4 if int(value) < 6 else 8
+
+
+def key_alters(fifths):
+    alters = {step: 0 for step in 'CDEFGAB'}
+    if fifths > 0:
+        for step in sharp_order[:fifths]:
+            alters[step] = 1
+    elif fifths < 0:
+        for step in sharp_order[::-1][:-fifths]:
+            alters[step] = -1
+    return alters
+
+
+def parse_pitch(value, fifths):
+    '''
+    Note token value ('C#4', 'Bb3' or MIDI number '61') to (step, alter, octave)
+    '''
+    if value.isdecimal():
+        midi = int(value)
+        if fifths < 0:
+            name = midi_names_flat[midi % 12]
+        elif fifths > 0:
+            name = midi_names_sharp[midi % 12]
+        else:
+            name = midi_names_natural[midi % 12]
+        return name[0], accidental_symbols[name[1:]], midi // 12 - 1
+
+    i = 1
+    while i < len(value) and value[i] in '#b-':
+        i += 1
+    return value[0], accidental_symbols[value[1:i]], int(value[i:])
+
+
+def group_to_notes(group, fifths):
+    '''
+    Note group to the list of notes to write (several for tied lengths),
+    each note is a dict: pitches, length, stem, beams, tie
+    '''
+    lengths = [parse_length(t) for t in group if t.startswith('len')]
+    if not lengths:
+        raise ValueError(f'No length for {" ".join(group)}')
+
+    if group[0] == 'rest':
+        return [{'pitches': [], 'length': lengths[0], 'stem': None, 'beams': [], 'tie': None}]
+
+    pitches = [parse_pitch(t.split('_')[1], fifths) for t in group if t.startswith('note')]
+    stems = [t.split('_')[1] for t in group if t.startswith('stem') or t.startswith('dir')]
+    beams = [t.split('_')[1:] for t in group if t.startswith('beam')]
+    ties = [t.split('_')[1] for t in group if t.startswith('tie')]
+
+    notes = []
+    for i, length in enumerate(lengths):
+        if len(lengths) > 1:
+            if ties:
+                tie = 'continue'
+            elif i == 0:
+                tie = 'start'
+            elif i == len(lengths) - 1:
+                tie = 'stop'
+            else:
+                tie = 'continue'
+        else:
+            tie = ties[0] if ties else None
+        notes.append({'pitches': pitches, 'length': length,
+                      'stem': stems[0] if stems else None,
+                      'beams': beams[0] if beams else [], 'tie': tie})
+    return notes
+
+
+def parse_hand(tokens, fifths=0):
+    '''
+    Hand tokens to measures, a measure being a list of items:
+    ('attributes', token), ('notes', [notes]), ('<voice>',) or ('</voice>',)
+    fifths is the key signature in effect before the first token
+    '''
+    measures = []
+    items = group_tokens(tokens)
+    for i, item in enumerate(items):
+        if isinstance(item, list):
+            # like tokens_to_PartStaff, groups of stray len/stem/beam/tie tokens are skipped
+            if measures and item[0].split('_')[0] in ('note', 'rest'):
+                measures[-1].append(('notes', group_to_notes(item, fifths)))
+            continue
+        if item == 'bar':
+            measures.append([])
+        elif not measures:
+            continue
+        elif item in ('<voice>', '</voice>'):
+            measures[-1].append((item,))
+        elif item.split('_')[0] in ('clef', 'key', 'time'):
+            if item[:11] == 'key_natural' and i + 1 < len(items) and isinstance(items[i + 1], str) \
+                    and items[i + 1].split('_')[0] == 'key':
+                # same workaround as tokens_to_PartStaff for consecutive key signatures
+                continue
+            if item.startswith('key'):
+                fifths = key_fifths(item)
+            measures[-1].append(('attributes', item))
+    return measures
+
+
+def note_type(length):
+    '''
+    Length in quarters to (type, dots, tuplet ratio), None when not representable
+    '''
+    for actual, normal in [(1, 1)] + tuplet_ratios:
+        base_length = length * Fraction(actual, normal)
+        for ql, name in note_types:
+            for dots in range(3):
+                if ql * (2 - Fraction(1, 2 ** dots)) == base_length:
+                    return name, dots, (actual, normal) if actual != 1 else None
+    return None
+
+
+def hand_measures_layout(measure, base_voice):
+    placed = []
+    position = Fraction(0)
+    voice_start, voice_end = None, Fraction(0)
+    voice, in_voice = None, False
+    for item in measure:
+        if item[0] == '<voice>':
+            if voice_start is None:
+                voice_start = position
+                voice = base_voice
+            elif in_voice:
+                voice_end = max(voice_end, position)
+                voice += 1
+            else:
+                voice += 1
+            in_voice = True
+            position = voice_start
+        elif item[0] == '</voice>':
+            if in_voice:
+                voice_end = max(voice_end, position)
+                in_voice = False
+                position = voice_end
+        else:
+            placed.append((position, voice if in_voice else base_voice, item))
+            if item[0] == 'notes':
+                position += sum(n['length'] for n in item[1])
+    end = max([position, voice_end] + [p + sum(n['length'] for n in it[1])
+                                       for p, _, it in placed if it[0] == 'notes'])
+    return placed, end
+
+
+def accidental_to_write(step, alter, octave, tie, accidentals, key_alter):
+    '''
+    Accidental to display for a pitch given the accidentals already
+    displayed in the measure and the key signature (like makeAccidentals)
+    '''
+    current = accidentals.get((step, octave), key_alter[step])
+    accidentals[(step, octave)] = alter
+    if tie in ('stop', 'continue') or current == alter:
+        return None
+    return accidental_names[alter]
+
+
+def note_to_xml(note, voice, staff, divisions, accidentals, key_alter):
+    lines = []
+    duration = note['length'] * divisions
+    type_ = note_type(note['length'])
+    # the tokenizer prepends chord notes, write them back in document order
+    pitches = note['pitches'][::-1] or [None]
+    for i, pitch in enumerate(pitches):
+        lines.append('<note>')
+        if i > 0:
+            lines.append('<chord/>')
+        if pitch is None:
+            lines.append('<rest/>')
+        else:
+            step, alter, octave = pitch
+            lines.append('<pitch>')
+            lines.append(f'<step>{step}</step>')
+            if alter:
+                lines.append(f'<alter>{alter}</alter>')
+            lines.append(f'<octave>{octave}</octave>')
+            lines.append('</pitch>')
+        lines.append(f'<duration>{int(duration)}</duration>')
+        tie = note['tie']
+        if tie in ('stop', 'continue'):
+            lines.append('<tie type="stop"/>')
+        if tie in ('start', 'continue'):
+            lines.append('<tie type="start"/>')
+        lines.append(f'<voice>{voice}</voice>')
+        if type_ is not None:
+            name, dots, tuplet = type_
+            lines.append(f'<type>{name}</type>')
+            lines += ['<dot/>'] * dots
+        if pitch is not None:
+            accidental = accidental_to_write(step, alter, octave, tie, accidentals, key_alter)
+            if accidental is not None:
+                lines.append(f'<accidental>{accidental}</accidental>')
+        if type_ is not None and type_[2] is not None:
+            actual, normal = type_[2]
+            lines.append(f'<time-modification><actual-notes>{actual}</actual-notes>'
+                         f'<normal-notes>{normal}</normal-notes></time-modification>')
+        if note['stem'] is not None and pitch is not None:
+            lines.append(f"<stem>{note['stem']}</stem>")
+        lines.append(f'<staff>{staff}</staff>')
+        if i == 0:
+            for level, b in enumerate(note['beams']):
+                lines.append(f'<beam number="{level + 1}">{beam_names.get(b, b)}</beam>')
+        if tie is not None and pitch is not None:
+            lines.append('<notations>')
+            if tie in ('stop', 'continue'):
+                lines.append('<tied type="stop"/>')
+            if tie in ('start', 'continue'):
+                lines.append('<tied type="start"/>')
+            lines.append('</notations>')
+        lines.append('</note>')
+    return lines
+
+
+def attributes_to_xml(tokens, staff, divisions=None, staves=None):
+    lines = ['<attributes>']
+    if divisions is not None:
+        lines.append(f'<divisions>{divisions}</divisions>')
+    for t in tokens:
+        if t.startswith('key'):
+            lines.append(f'<key number="{staff}"><fifths>{key_fifths(t)}</fifths></key>')
+    for t in tokens:
+        if t.startswith('time'):
+            beats, beat_type = time_signature(t)
+            lines.append(f'<time number="{staff}"><beats>{beats}</beats>'
+                         f'<beat-type>{beat_type}</beat-type></time>')
+    if staves is not None:
+        lines.append(f'<staves>{staves}</staves>')
+    for t in tokens:
+        if t.startswith('clef'):
+            sign, line = ('G', 2) if t == 'clef_treble' else ('F', 4)
+            lines.append(f'<clef number="{staff}"><sign>{sign}</sign><line>{line}</line></clef>')
+    lines.append('</attributes>')
+    return lines
+
+
+def move_to(position, cursor, divisions):
+    if position > cursor:
+        return [f'<forward><duration>{int((position - cursor) * divisions)}</duration></forward>']
+    elif position < cursor:
+        return [f'<backup><duration>{int((cursor - position) * divisions)}</duration></backup>']
+    return []
+
+
+def staff_to_xml(placed, staff, divisions, state, header=None):
+    '''
+    Write the placed items of one staff, state holds the current key (fifths)
+    of the staff. header is (divisions, staves) for the very first attributes.
+    Returns the lines and the final cursor position.
+    '''
+    lines = []
+    cursor = Fraction(0)
+    accidentals = {}
+    if header is not None and not (placed and placed[0][2][0] == 'attributes' and placed[0][0] == 0):
+        lines += attributes_to_xml([], staff, *header)
+        header = None
+    i = 0
+    while i < len(placed):
+        position, voice, item = placed[i]
+        lines += move_to(position, cursor, divisions)
+        cursor = position
+        if item[0] == 'attributes':
+            # merge consecutive attributes at the same position
+            tokens = [item[1]]
+            while i + 1 < len(placed) and placed[i + 1][2][0] == 'attributes' and placed[i + 1][0] == position:
+                i += 1
+                tokens.append(placed[i][2][1])
+            if header is not None:
+                lines += attributes_to_xml(tokens, staff, *header)
+                header = None
+            else:
+                lines += attributes_to_xml(tokens, staff)
+            for t in tokens:
+                if t.startswith('key'):
+                    state['fifths'] = key_fifths(t)
+        else:
+            key_alter = key_alters(state['fifths'])
+            for note in item[1]:
+                lines += note_to_xml(note, voice, staff, divisions, accidentals, key_alter)
+                cursor += note['length']
+        i += 1
+    return lines, cursor
+
+
+def get_divisions(hands):
+    denominators = [1]
+    for measures in hands:
+        for measure in measures:
+            for item in measure:
+                if item[0] == 'notes':
+                    denominators += [n['length'].denominator for n in item[1]]
+    return math.lcm(*denominators)
+
+
+def tokens_to_musicxml(string):
+    '''
+    Token sequence (string) to MusicXML text, without building music21 objects
+    '''
+    R_tokens, L_tokens = split_hands(string)
+    hands = [parse_hand(R_tokens), parse_hand(L_tokens)]
+    divisions = get_divisions(hands)
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.1 Partwise//EN" '
+             '"http://www.musicxml.org/dtds/partwise.dtd">',
+             '<score-partwise version="3.1">',
+             '<part-list><score-part id="P1"><part-name>Piano</part-name></score-part></part-list>',
+             '<part id="P1">']
+
+    states = [{'fifths': 0}, {'fifths': 0}]
+    n_measures = max(len(hands[0]), len(hands[1]))
+    for m in range(n_measures):
+        lines.append(f'<measure number="{m + 1}">')
+        cursor = Fraction(0)
+        for staff, measures in enumerate(hands, start=1):
+            measure = measures[m] if m < len(measures) else []
+            placed, _ = hand_measures_layout(measure, base_voice=1 if staff == 1 else 5)
+            header = (divisions, 2) if m == 0 and staff == 1 else None
+            if staff == 2:
+                lines += move_to(Fraction(0), cursor, divisions)
+            staff_lines, cursor = staff_to_xml(placed, staff, divisions, states[staff - 1], header)
+            lines += staff_lines
+        if m == n_measures - 1:
+            lines.append('<barline location="right"><bar-style>regular</bar-style></barline>')
+        lines.append('</measure>')
+
+    lines += ['</part>', '</score-partwise>']
+    return '\n'.join(lines)
+
+
+def write_musicxml(string, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(tokens_to_musicxml(string))
+
+
+def compare_notes(xml_a, xml_b):
+    '''
+    Compare the notes (measure, onset in the measure, duration, pitch, staff)
+    of two MusicXML files, returns the number of notes only in a and only in b.
+    Onsets are taken relative to the first note of each measure, so that a
+    different measure length in one file does not shift all the following notes.
+    '''
+    import numpy as np
+    from score_to_tokens_stream import MusicXML_to_events
+
+    def note_counts(path):
+        events = MusicXML_to_events(path)
+        counts = {}
+        if not len(events):
+            return counts
+        measure_start = np.full(events['measure'].max() + 1, np.inf)
+        np.minimum.at(measure_start, events['measure'], events['onset'])
+        onsets = np.round(events['onset'] - measure_start[events['measure']], 6)
+        rows = zip(events['measure'].tolist(), onsets.tolist(), np.round(events['duration'], 6).tolist(),
+                   events['pitch'].tolist(), events['staff'].tolist())
+        for row in rows:
+            counts[row] = counts.get(row, 0) + 1
+        return counts
+
+    a, b = note_counts(xml_a), note_counts(xml_b)
+    only_a = sum(max(0, c - b.get(k, 0)) for k, c in a.items())
+    only_b = sum(max(0, c - a.get(k, 0)) for k, c in b.items())
+    return only_a, only_b
+
+
+def check_against_music21(paths, tmp_dir):
+    '''
+    Tokenize each file, decode it with both writers and compare the notes
+    '''
+    from score_to_tokens_stream import MusicXML_to_tokens_stream
+    from tokens_to_score import tokens_to_score
+
+    report = []
+    for path in tqdm(paths, 'Checking'):
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            string = ' '.join(t for t in MusicXML_to_tokens_stream(path) if t is not None)
+            music21_path = os.path.join(tmp_dir, name + '_music21.musicxml')
+            direct_path = os.path.join(tmp_dir, name + '_direct.musicxml')
+            tokens_to_score(string).write('musicxml', music21_path)
+            write_musicxml(string, direct_path)
+            only_music21, only_direct = compare_notes(music21_path, direct_path)
+            report.append({'path': path, 'only_music21': only_music21, 'only_direct': only_direct})
+        except Exception as e:
+            report.append({'path': path, 'error': f'{type(e).__name__}: {e}'})
+    return report
+
+
+def main():
+    import tempfile
+    args = parse_args()
+    paths = sorted(os.path.join(args.check, f) for f in os.listdir(args.check)
+                   if f.endswith('.musicxml') or f.endswith('.xml'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report = check_against_music21(paths, tmp_dir)
+
+    identical = 0
+    for r in report:
+        if 'error' in r:
+            print(f"{r['path']}: {r['error']}")
+        elif r['only_music21'] or r['only_direct']:
+            print(f"{r['path']}: {r['only_music21']} note(s) only in music21 output, "
+                  f"{r['only_direct']} only in direct output")
+        else:
+            identical += 1
+    print(f'{identical}/{len(report)} scores with identical notes')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,17 @@ https://github.com/suzuqn/ScoreTransformer
 
 """
 
+from collections import namedtuple
 from music21 import *
 
 # dictionary to change note names
 sharp_to_flat = {'C#': 'D-', 'D#': 'E-', 'F#': 'G-', 'G#': 'A-', 'A#': 'B-'}
 flat_to_sharp = {v: k for k, v in sharp_to_flat.items()}
 
+# parsed form of a regular token, names holds the note name for a flat, natural and sharp key signature
+ParsedToken = namedtuple('ParsedToken', 'text kind names length stem beams tie')
+parsed_tokens = {}
+
 # translate note numbers into note names considering key signature
 
 
@@ -27,36 +32,75 @@ def pitch_to_name(pitch_, key=key.KeySignature(0)):
     else:
         return pitch_.replace('b', '-')
 
+
+def key_index(key):
+    return 0 if key.sharps < 0 else 2 if key.sharps > 0 else 1
+
+
+def parse_token(t):
+    '''
+    Split a regular token once, results are memoized per token string
+    '''
+    if t in parsed_tokens:
+        return parsed_tokens[t]
+
+    parts = t.split('_')
+    names, length, stem, beams, tie_ = None, None, None, None, None
+    if parts[0] == 'note':
+        names = tuple(pitch_to_name(parts[1], key.KeySignature(sharps)) for sharps in (-1, 0, 1))
+    elif parts[0] == 'len':
+        length = str_to_float(t)
+    elif parts[0] in ('stem', 'dir'):
+        stem = parts[1]
+    elif parts[0] == 'beam':
+        beams = parts[1:]
+    elif parts[0] == 'tie':
+        tie_ = parts[1]
+
+    parsed = ParsedToken(t, parts[0], names, length, stem, beams, tie_)
+    parsed_tokens[t] = parsed
+    return parsed
+
+
+def compile_vocab(id_to_token):
+    '''
+    Parse table indexed by token ID: the parsed regular tokens of each vocabulary token
+    '''
+    return [tuple(parse_token(t) for t in concatenated_to_regular([token])) for token in id_to_token]
+
 # aggregate note(rest)-related tokens
 
 
 def aggr_note_token(tokens):
+    '''
+    tokens: list of ParsedToken, note groups are returned as lists
+    '''
     notes, others, out = [], [], []
     note_flag, len_flag = False, False
 
     for t in tokens:
-        parts = t.split('_')
-        if parts[0] in ('note', 'rest'):
+        kind = t.kind
+        if kind in ('note', 'rest'):
             if note_flag and len_flag and len(notes):
-                out.append(' '.join(notes))
+                out.append(notes)
                 notes = []
             note_flag = True
             len_flag = False
             notes.append(t)
-        elif parts[0] == 'len':
+        elif kind == 'len':
             len_flag = True
             notes.append(t)
-        elif parts[0] in ('stem', 'beam', 'tie'):
+        elif kind in ('stem', 'beam', 'tie'):
             notes.append(t)
         else:  # other than note-related
             if len(notes):
-                out.append(' '.join(notes))
+                out.append(notes)
                 notes = []
             out.append(t)
 
     # buffer flush
     if len(notes):
-        out.append(' '.join(notes))
+        out.append(notes)
 
     return out
 
@@ -87,19 +131,18 @@ def single_token_to_obj(token):
 
 
 def note_token_to_obj(tokens, key):
-    if tokens[0] == 'rest':  # for rests
-        length = str_to_float(tokens[1])
+    tokens = [parse_token(t) if isinstance(t, str) else t for t in tokens]
+    if tokens[0].kind == 'rest':  # for rests
+        length = tokens[1].length if tokens[1].kind == 'len' else str_to_float(tokens[1].text)
         return note.Rest(quarterLength=length)
 
     # for notes
-    note_names = [pitch_to_name(t.split('_')[1], key)
-                  for t in tokens if t.split('_')[0] == 'note']
-    lengths = [str_to_float(t) for t in tokens if t.split('_')[0] == 'len']
-    direction = [t.split('_')[1] for t in tokens if t.split('_')[0] in ('stem', 'dir')] + [
-        t.split('_')[2] for t in tokens if t.split('_')[0] == 'len' and len(t.split('_')) >= 3]
-    beams = [t.split('_')[1:] for t in tokens if t.split('_')[0] == 'beam'] + [t.split('_')[3:]
-                                                                               for t in tokens if t.split('_')[0] == 'len' and len(t.split('_')) >= 4]
-    tie_ = [t.split('_')[1] for t in tokens if t.split('_')[0] == 'tie']
+    k = key_index(key)
+    note_names = [t.names[k] for t in tokens if t.kind == 'note']
+    lengths = [t.length for t in tokens if t.kind == 'len']
+    direction = [t.stem for t in tokens if t.kind in ('stem', 'dir')]
+    beams = [t.beams for t in tokens if t.kind == 'beam']
+    tie_ = [t.tie for t in tokens if t.kind == 'tie']
 
     if len(note_names) > 1:  # chord
         if len(lengths) > 1:
@@ -190,7 +233,11 @@ def append_beams(obj, beams):
 
 
 def tokens_to_PartStaff(tokens, key_=0, start_voice=1):
-    tokens = concatenated_to_regular(tokens)
+    '''
+    tokens: token strings, or ParsedToken (already regular) as given by a parse table
+    '''
+    if tokens and isinstance(tokens[0], str):
+        tokens = [parse_token(t) for t in concatenated_to_regular(tokens)]
 
     p = stream.PartStaff()
     k = key.KeySignature(key_)
@@ -206,6 +253,24 @@ def tokens_to_PartStaff(tokens, key_=0, start_voice=1):
     tokens = aggr_note_token(tokens)
 
     for i, t in enumerate(tokens):
+        if isinstance(t, list):  # note(rest) group
+            if t[0].kind not in ('note', 'rest'):  # stray len/stem/beam/tie tokens are skipped
+                continue
+            n = note_token_to_obj(t, k)
+            if ottava_flag:
+                ottava_elements.append(n)
+
+            if voice_flag:
+                v.append(n)
+            else:
+                m.append(n)
+
+            if after_voice:
+                n.offset -= v.quarterLength * (voice_id - 1)
+            continue
+
+        kind = t.kind
+        t = t.text
         if t == 'bar':
             if i != 0:
                 p.append(m)
@@ -228,8 +293,8 @@ def tokens_to_PartStaff(tokens, key_=0, start_voice=1):
                 voice_id += 1
                 voice_flag = False
                 after_voice = True
-        elif t.split('_')[0] in ('clef', 'key', 'time'):
-            if t[:11] == 'key_natural' and i+1 < len(tokens) and tokens[i+1].split('_')[0] == 'key':
+        elif kind in ('clef', 'key', 'time'):
+            if t[:11] == 'key_natural' and i+1 < len(tokens) and not isinstance(tokens[i+1], list) and tokens[i+1].kind == 'key':
                 # workaround for MuseScore (which ignores consecutive key signtures): if key signatures appear in succession, skip the one with natural
                 continue
             o = single_token_to_obj(t)
@@ -238,20 +303,8 @@ def tokens_to_PartStaff(tokens, key_=0, start_voice=1):
             else:
                 m.append(o)
             # generate another key signature object to use makeAccidentals and to translate note number to name
-            if t.split('_')[0] == 'key':
+            if kind == 'key':
                 k = o
-        elif t[:4] in ('note', 'rest'):
-            n = note_token_to_obj(t.split(), k)
-            if ottava_flag:
-                ottava_elements.append(n)
-
-            if voice_flag:
-                v.append(n)
-            else:
-                m.append(n)
-
-            if after_voice:
-                n.offset -= v.quarterLength * (voice_id - 1)
     # last measure
     p.append(m)
     p.makeAccidentals()
@@ -280,8 +333,22 @@ def concatenated_to_regular(tokens):
 
 def tokens_to_score(string, voice_numbering=False):
     R_str, L_str = split_R_L(string)
-    R_tokens = R_str.split()
-    L_tokens = L_str.split()
+    return hands_to_score(R_str.split(), L_str.split(), voice_numbering)
+
+
+def ids_to_score(ids, table, voice_numbering=False):
+    '''
+    Same as tokens_to_score for a sequence of token IDs, reading the parse table
+    built by compile_vocab instead of parsing the token strings
+    '''
+    tokens = [t for i in ids for t in table[i]]
+    texts = [t.text for t in tokens]
+    R_index = texts.index('R')
+    L_index = texts.index('L') if 'L' in texts else len(tokens)
+    return hands_to_score(tokens[R_index + 1:L_index], tokens[L_index + 1:], voice_numbering)
+
+
+def hands_to_score(R_tokens, L_tokens, voice_numbering=False):
     if voice_numbering:
         r = tokens_to_PartStaff(R_tokens)
         r_voices = max([len(m.voices) if m.hasVoices() else 1 for m in r])